@@ -0,0 +1,34 @@
+"""Client for the pool of long-lived PhantomJS renderers started by the
+`run_renderers` management command (see `scripts/render_server.js`).
+"""
+import itertools
+import logging
+
+import requests
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_job_counter = itertools.count()
+
+
+def render(job):
+    """Send a render job to the next renderer in `settings.RENDERER_URLS`.
+
+    Returns True once the renderer has written `job["output"]`, or False
+    if there are no renderers configured or the chosen one isn't
+    running, timed out or failed, in which case the caller should render
+    it some other way.
+    """
+    urls = settings.RENDERER_URLS
+    if not urls:
+        return False
+    url = urls[next(_job_counter) % len(urls)]
+    try:
+        response = requests.post(url, json=job, timeout=settings.RENDERER_TIMEOUT)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        logger.warning("Renderer at %s failed to render %s: %s", url, job["output"], e)
+        return False
+    return True
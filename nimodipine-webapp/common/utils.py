@@ -1,4 +1,5 @@
 import base64
+from functools import lru_cache
 import logging
 import re
 import subprocess
@@ -10,8 +11,13 @@ from titlecase import titlecase
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
+from common import renderer
+
 logger = logging.getLogger(__name__)
 
+NON_DIGITS = re.compile(r"[^0-9]")
+EIGHT_DIGITS = re.compile(r"[0-9]{8}")
+
 
 def not_empty(cell):
     "Is a Google Sheets cell truthy?"
@@ -21,39 +27,76 @@ def not_empty(cell):
     return False
 
 
-def nhs_abbreviations(word, **kwargs):
-    if len(word) == 2 and word.lower() not in [
-        "at",
-        "of",
-        "in",
-        "on",
-        "to",
-        "is",
-        "me",
-        "by",
-        "dr",
-        "st",
-    ]:
+def normalise_fax(fax):
+    """Convert a free-text UK fax number to the international format
+    that InterFAX expects (e.g. `0044...`)
+    """
+    fax_number = NON_DIGITS.sub("", fax or "")
+    if fax_number and EIGHT_DIGITS.search(fax_number):
+        if fax_number[:2] != "00":
+            if fax_number[0] == "0":
+                fax_number = fax_number[1:]
+            if fax_number[:2] == "44":
+                fax_number = "00" + fax_number
+            else:
+                fax_number = "0044" + fax_number
+    return fax_number
+
+
+# Two-letter words which aren't abbreviations
+NHS_TITLE_WORDS = frozenset(["dr", "st"])
+NHS_TWO_LETTER_WORDS = (
+    frozenset(["at", "of", "in", "on", "to", "is", "me", "by"]) | NHS_TITLE_WORDS
+)
+NHS_ACRONYMS = frozenset(["NHS", "CCG", "PMS", "SMA", "PWSI", "OOH", "HIV"])
+# Words without vowels which aren't abbreviations
+NHS_VOWELLESS_WORDS = frozenset(["ptnrs", "by", "ccgs"])
+VOWEL = re.compile(r"[aeiou]")
+DR_LOWERCASE = re.compile(r"Dr ([a-z]{2})")
+
+
+@lru_cache(maxsize=4096)
+def nhs_word_case(word):
+    """Return the casing of a single word in an NHS organisation name, or
+    None to leave it to `titlecase`.
+
+    Practice names are made from a small vocabulary, so this is memoised.
+    """
+    lower = word.lower()
+    if len(word) == 2 and lower not in NHS_TWO_LETTER_WORDS:
         return word.upper()
-    elif word.lower() in ["dr", "st"]:
+    elif lower in NHS_TITLE_WORDS:
         return word.title()
-    elif word.upper() in ("NHS", "CCG", "PMS", "SMA", "PWSI", "OOH", "HIV"):
+    elif word.upper() in NHS_ACRONYMS:
         return word.upper()
     elif "&" in word:
         return word.upper()
-    elif (word.lower() not in ["ptnrs", "by", "ccgs"]) and (
-        not re.match(r".*[aeiou]{1}", word.lower())
-    ):
+    elif lower not in NHS_VOWELLESS_WORDS and not VOWEL.search(lower):
         return word.upper()
 
 
+def nhs_abbreviations(word, **kwargs):
+    return nhs_word_case(word)
+
+
 def nhs_titlecase(words):
     if words:
         title_cased = titlecase(words, callback=nhs_abbreviations)
-        words = re.sub(r"Dr ([a-z]{2})", "Dr \1", title_cased)
+        words = DR_LOWERCASE.sub("Dr \1", title_cased)
     return words
 
 
+def nhs_titlecase_all(names):
+    """Title case a column of NHS organisation names, casing each distinct
+    name only once
+    """
+    cased = {}
+    for name in names:
+        if name not in cased:
+            cased[name] = nhs_titlecase(name)
+    return [cased[name] for name in names]
+
+
 def get_env_setting(setting, default=None):
     """ Get the environment setting.
 
@@ -82,18 +125,27 @@ def grab_image(url, file_path, selector, dimensions="800x5000"):
         dimensions = "800x600"
     else:
         wait = 1000
-    cmd = '{cmd} "{host}{url}" {file_path} "{selector}" {dimensions} {wait}'
-    cmd = cmd.format(
-        cmd=settings.GRAB_CMD,
-        host=settings.GRAB_HOST,
-        url=url,
-        file_path=file_path,
-        selector=selector,
-        dimensions=dimensions,
-        wait=wait,
-    )
-    result = subprocess.check_output(cmd, shell=True)
-    logger.debug("Command %s completed with output %s" % (cmd, result.strip()))
+    job = {
+        "format": "png",
+        "url": settings.GRAB_HOST + url,
+        "output": file_path,
+        "selector": selector,
+        "dimensions": dimensions,
+        "wait": wait,
+    }
+    if not renderer.render(job):
+        cmd = '{cmd} "{host}{url}" {file_path} "{selector}" {dimensions} {wait}'
+        cmd = cmd.format(
+            cmd=settings.GRAB_CMD,
+            host=settings.GRAB_HOST,
+            url=url,
+            file_path=file_path,
+            selector=selector,
+            dimensions=dimensions,
+            wait=wait,
+        )
+        result = subprocess.check_output(cmd, shell=True)
+        logger.debug("Command %s completed with output %s" % (cmd, result.strip()))
     with open(file_path, "rb") as image_file:
         encoded_image = base64.b64encode(image_file.read())
         return encoded_image.decode("ascii")
@@ -1,7 +1,9 @@
 from django.contrib import admin
+from nimodipine.models import ClickEvent
 from nimodipine.models import InterventionContact
 from nimodipine.models import Intervention
 from nimodipine.models import MailLog
+from nimodipine.models import MailLogRollup
 
 
 class InterventionContactAdmin(admin.ModelAdmin):
@@ -20,6 +22,15 @@ class InterventionAdmin(admin.ModelAdmin):
 admin.site.register(Intervention, InterventionAdmin)
 
 
+class ClickEventAdmin(admin.ModelAdmin):
+    list_display = ("timestamp", "intervention", "user_agent")
+    list_filter = ("intervention__method",)
+    search_fields = ("intervention__practice_id",)
+
+
+admin.site.register(ClickEvent, ClickEventAdmin)
+
+
 class MailLogAdmin(admin.ModelAdmin):
     list_filter = ("recipient", "tags", "event_type")
     search_fields = ("recipient",)
@@ -30,3 +41,12 @@ class MailLogAdmin(admin.ModelAdmin):
 
 
 admin.site.register(MailLog, MailLogAdmin)
+
+
+class MailLogRollupAdmin(admin.ModelAdmin):
+    list_display = ("recipient", "delivered", "opened", "clicked", "bounced")
+    list_filter = ("delivered", "opened", "clicked", "bounced")
+    search_fields = ("recipient",)
+
+
+admin.site.register(MailLogRollup, MailLogRollupAdmin)
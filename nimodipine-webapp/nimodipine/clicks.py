@@ -0,0 +1,192 @@
+"""Write-behind logging of clicks on tracked URLs.
+
+When `settings.CLICK_LOG_PATH` is set, `measure_redirect` appends each
+click to that file as a line of JSON and redirects without writing to
+the database. `flush_click_log()` (run periodically by `manage.py
+flush_clicks`) then applies the logged clicks in batches.
+
+What a click needs to know about its intervention is kept in the
+"redirects" cache, so that repeat clicks don't query the database.
+"""
+from collections import Counter
+import glob
+import json
+import logging
+import os
+import time
+
+from django.core.cache import caches
+from django.db import connection
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from psycopg2.extras import execute_values
+
+from nimodipine.models import ClickEvent
+from nimodipine.models import ClickLogBatch
+from nimodipine.models import Intervention
+from nimodipine.models import InterventionContact
+from nimodipine.models import target_url
+
+logger = logging.getLogger(__name__)
+
+
+def click_target(method, practice_id):
+    """Return a dict of the target URL, contact ID, and whether that
+    contact has visited before, for the given intervention; or None if
+    there is no such intervention.
+
+    Looked up in a single query the first time, and cached after that.
+    Whether the contact has visited is cached separately, as it's shared
+    by all their interventions, and never expires, as until their clicks
+    are flushed the database doesn't know.
+    """
+    cache = caches["redirects"]
+    key = "target:{}:{}".format(method, practice_id)
+    target = cache.get(key)
+    if target is None:
+        row = (
+            Intervention.objects.filter(method=method, practice_id=practice_id)
+            .values_list("contact_id", "contact__hits")
+            .first()
+        )
+        if row is None:
+            return None
+        contact_id, contact_hits = row
+        target = {
+            "target_url": target_url(method, practice_id),
+            "contact_id": contact_id,
+        }
+        cache.set(key, target)
+        # Clicks on their other interventions may not have been flushed
+        visited_key = "visited:{}".format(contact_id)
+        visited = cache.get(visited_key) or contact_hits > 0
+        cache.set(visited_key, visited, None)
+    else:
+        visited_key = "visited:{}".format(target["contact_id"])
+        visited = cache.get(visited_key)
+        if visited is None:
+            visited = InterventionContact.objects.filter(
+                pk=target["contact_id"], hits__gt=0
+            ).exists()
+            cache.set(visited_key, visited, None)
+    return dict(target, visited=visited)
+
+
+def mark_visited(contact_id):
+    caches["redirects"].set("visited:{}".format(contact_id), True, None)
+
+
+def log_click(path, method, practice_id, user_agent=""):
+    """Append a click to the log at `path`.
+
+    Each click is a single short write to a file opened for appending,
+    so clicks from several gunicorn workers don't interleave.
+    """
+    line = json.dumps(
+        {
+            "method": method,
+            "practice_id": practice_id,
+            "timestamp": timezone.now().isoformat(),
+            "user_agent": user_agent,
+        }
+    )
+    with open(path, "a") as f:
+        f.write(line + "\n")
+
+
+def read_clicks(path):
+    clicks = []
+    with open(path) as f:
+        for line in f:
+            try:
+                clicks.append(json.loads(line))
+            except ValueError:
+                # A partial line from a worker that died mid-write
+                logger.warning("Skipping unreadable click in %s: %r", path, line)
+    return clicks
+
+
+def apply_clicks(clicks, batch_size=1000):
+    """Record a batch of logged clicks, as `record_hit()` would have done
+    for each: add them to the intervention and contact hit counters and
+    create a ClickEvent for each.
+
+    Returns the number of clicks applied; clicks for unknown
+    interventions are dropped.
+    """
+    practice_ids = {click["practice_id"] for click in clicks}
+    interventions = {
+        (method, practice_id): (pk, contact_id)
+        for pk, method, practice_id, contact_id in Intervention.objects.filter(
+            practice_id__in=practice_ids
+        ).values_list("pk", "method", "practice_id", "contact_id")
+    }
+    events = []
+    intervention_hits = Counter()
+    contact_hits = Counter()
+    for click in clicks:
+        key = (click["method"], click["practice_id"])
+        if key not in interventions:
+            logger.warning("Dropping click for unknown intervention %s", key)
+            continue
+        pk, contact_id = interventions[key]
+        intervention_hits[pk] += 1
+        contact_hits[contact_id] += 1
+        events.append(
+            ClickEvent(
+                intervention_id=pk,
+                timestamp=parse_datetime(click["timestamp"]),
+                user_agent=click["user_agent"],
+            )
+        )
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            for table, pk_column, hits in [
+                (Intervention._meta.db_table, "id", intervention_hits),
+                (InterventionContact._meta.db_table, "practice_id", contact_hits),
+            ]:
+                execute_values(
+                    cursor,
+                    """
+                    UPDATE {table} SET hits = {table}.hits + clicks.hits
+                    FROM (VALUES %s) AS clicks (pk, hits)
+                    WHERE {table}.{pk_column} = clicks.pk
+                    """.format(
+                        table=table, pk_column=pk_column
+                    ),
+                    list(hits.items()),
+                    page_size=batch_size,
+                )
+        ClickEvent.objects.bulk_create(events, batch_size=batch_size)
+    return len(events)
+
+
+def flush_click_log(path, grace=1.0, batch_size=1000):
+    """Apply all the clicks logged at `path` so far.
+
+    The log is first moved aside, so that new clicks go to a fresh file
+    while we work; `grace` seconds are allowed for any writes already in
+    progress to finish. Each moved-aside log is recorded as a
+    ClickLogBatch in the same transaction as its clicks, and only then
+    deleted. So any left over from an interrupted flush are applied the
+    next time round, unless they already have been.
+
+    Returns the number of clicks applied.
+    """
+    if os.path.exists(path):
+        os.rename(path, "{}.{}.flushing".format(path, time.time()))
+        time.sleep(grace)
+    applied = 0
+    for flushing in sorted(glob.glob(glob.escape(path) + ".*.flushing")):
+        name = os.path.basename(flushing)
+        with transaction.atomic():
+            if ClickLogBatch.objects.filter(name=name).exists():
+                logger.warning("Skipping already applied click log %s", flushing)
+            else:
+                clicks = read_clicks(flushing)
+                if clicks:
+                    applied += apply_clicks(clicks, batch_size)
+                ClickLogBatch.objects.create(name=name)
+        os.remove(flushing)
+    return applied
@@ -0,0 +1,130 @@
+"""Combine generated letters into PDFs for printing.
+
+Letters are merged with Ghostscript as a tree: chunks of letters are
+merged in parallel, then the results merged, and so on, so a big wave
+uses every core and no single command line gets too long. When there is
+a manifest, only letters that haven't been combined before are merged,
+into new PDFs, so each run only does the new work.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import fnmatch
+import os
+import subprocess
+import tempfile
+
+from django.conf import settings
+
+from nimodipine.manifest import open_manifest
+from nimodipine.manifest import record_combined
+from nimodipine.manifest import uncombined_artefacts
+from nimodipine.models import InterventionContact
+
+# The most PDFs to pass to a single Ghostscript
+MERGE_FAN_IN = 100
+
+
+def find(pattern, path):
+    result = []
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            if fnmatch.fnmatch(name, pattern):
+                result.append(os.path.join(root, name))
+    return result
+
+
+def gs_merge(inputs, output):
+    subprocess.check_call(
+        [
+            "gs",
+            "-q",
+            "-sPAPERSIZE=letter",
+            "-dNOPAUSE",
+            "-dBATCH",
+            "-sDEVICE=pdfwrite",
+            "-sOutputFile={}".format(output),
+        ]
+        + inputs
+    )
+
+
+def merge_pdfs(inputs, output, workers=None, fan_in=MERGE_FAN_IN):
+    """Merge `inputs` into `output`, merging up to `workers` chunks of
+    `fan_in` PDFs at a time (by default, one per core)
+    """
+    workers = workers or os.cpu_count() or 1
+    output_dir = os.path.dirname(output)
+    with tempfile.TemporaryDirectory(dir=output_dir) as tmp_dir:
+        level = 0
+        while len(inputs) > fan_in:
+            chunks = [inputs[i : i + fan_in] for i in range(0, len(inputs), fan_in)]
+            outputs = [
+                os.path.join(tmp_dir, "{}-{}.pdf".format(level, i))
+                for i in range(len(chunks))
+            ]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(gs_merge, chunks, outputs))
+            inputs = outputs
+            level += 1
+        # Write then rename, so a half-written PDF is never printed
+        tmp_output = os.path.join(tmp_dir, "output.pdf")
+        gs_merge(inputs, tmp_output)
+        os.replace(tmp_output, output)
+
+
+def order_by_postcode(letters):
+    """Sort `(path, practice_id)` pairs by the practice's postcode"""
+    postcodes = dict(
+        InterventionContact.objects.filter(
+            pk__in=[practice_id for _, practice_id in letters]
+        ).values_list("pk", "postcode")
+    )
+    return sorted(
+        letters,
+        key=lambda letter: ((postcodes.get(letter[1]) or "").upper(), letter[1]),
+    )
+
+
+def combine_letters(batch_size=None, by_postcode=False, workers=None):
+    """Combine letters into PDFs of up to `batch_size` letters each (or one
+    PDF, if not set), optionally ordered by postcode.
+
+    With a manifest, only letters not already combined are included, and
+    each run's PDFs are named for the time it started. Without one, every
+    letter under DATA_DIR is combined, into `combined_letters.pdf` as
+    before if there's only one batch.
+
+    Returns the paths of the PDFs written.
+    """
+    manifest = open_manifest()
+    if manifest:
+        letters = uncombined_artefacts(manifest, method="p")
+    else:
+        letters = [
+            (path, os.path.basename(os.path.dirname(path)))
+            for path in find("letter.pdf", settings.DATA_DIR)
+        ]
+    if by_postcode:
+        letters = order_by_postcode(letters)
+    paths = [path for path, _ in letters]
+    if not batch_size:
+        batch_size = len(paths) or 1
+    batches = [paths[i : i + batch_size] for i in range(0, len(paths), batch_size)]
+    outputs = []
+    if manifest:
+        prefix = "combined_letters_" + datetime.now().strftime("%Y%m%d-%H%M%S")
+    else:
+        prefix = "combined_letters"
+    for i, batch in enumerate(batches, 1):
+        if manifest or len(batches) > 1:
+            filename = "{}_{:03d}.pdf".format(prefix, i)
+        else:
+            filename = prefix + ".pdf"
+        output = os.path.join(settings.DATA_DIR, filename)
+        merge_pdfs(batch, output, workers)
+        if manifest:
+            record_combined(manifest, batch, output)
+        outputs.append(output)
+    if manifest:
+        manifest.close()
+    return outputs
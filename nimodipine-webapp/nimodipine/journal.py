@@ -0,0 +1,117 @@
+"""Journals of the items handled by `generate_wave` and `send_messages`
+runs, so that an interrupted run can be resumed.
+
+Each run has a JSON lines file in `settings.DATA_DIR/journal`. The
+first line records the run's options and the items it is to handle;
+each line after that records an item changing state. Resuming a run
+reads its journal back and handles only the items which aren't yet
+finished, without rediscovering them from the filesystem or database.
+"""
+from datetime import datetime
+import json
+import logging
+import os
+import threading
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_DIRNAME = "journal"
+
+# States in which an item needs no more work on resuming
+FINISHED_STATES = ("done", "skipped")
+
+
+def journal_path(run_id):
+    return os.path.join(settings.DATA_DIR, JOURNAL_DIRNAME, run_id + ".jsonl")
+
+
+class Journal:
+    """An append-only record of the state of each item in a run.
+
+    Safe to record to from several threads.
+    """
+
+    def __init__(self, run_id, command, options, items, entries=None):
+        self.run_id = run_id
+        self.command = command
+        self.options = options
+        self.items = items
+        # The latest entry recorded for each item
+        self.entries = entries or {}
+        self.lock = threading.Lock()
+        self.f = open(journal_path(run_id), "a")
+
+    @classmethod
+    def start(cls, command, items, **options):
+        """Start a journal for a new run of `command` over `items`, which
+        must be JSON strings or numbers
+        """
+        run_id = "{}-{}".format(command, datetime.utcnow().strftime("%Y%m%dT%H%M%S%f"))
+        os.makedirs(os.path.dirname(journal_path(run_id)), exist_ok=True)
+        journal = cls(run_id, command, options, items)
+        journal._write(
+            {"run": run_id, "command": command, "options": options, "items": items}
+        )
+        return journal
+
+    @classmethod
+    def resume(cls, run_id, command):
+        """Reopen the journal of an earlier run of `command`.
+
+        Raises ValueError if there is no such run.
+        """
+        path = journal_path(run_id)
+        if not os.path.exists(path):
+            raise ValueError("No journal for run {}".format(run_id))
+        entries = {}
+        with open(path) as f:
+            line = f.readline()
+            try:
+                header = json.loads(line)
+            except ValueError:
+                raise ValueError(
+                    "Run {} stopped before it started; run it again "
+                    "instead".format(run_id)
+                )
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A partial line from when the run was interrupted
+                    logger.warning("Skipping unreadable entry in %s: %r", path, line)
+                    continue
+                entries[entry["item"]] = entry
+        if header["command"] != command:
+            raise ValueError("Run {} is not a {} run".format(run_id, command))
+        journal = cls(run_id, command, header["options"], header["items"], entries)
+        if not line.endswith("\n"):
+            # Don't append to a partial line left by an interrupted write
+            journal.f.write("\n")
+            journal.f.flush()
+        return journal
+
+    def _write(self, entry):
+        # Flushed straight away, so nothing is lost if the run dies
+        with self.lock:
+            self.f.write(json.dumps(entry) + "\n")
+            self.f.flush()
+
+    def record(self, item, state, **extra):
+        entry = dict(extra, item=item, state=state, at=datetime.utcnow().isoformat())
+        self._write(entry)
+        with self.lock:
+            self.entries[item] = entry
+
+    def state(self, item):
+        entry = self.entries.get(item)
+        return entry and entry["state"]
+
+    def pending(self):
+        """Return the items not yet finished, in their original order
+        """
+        return [x for x in self.items if self.state(x) not in FINISHED_STATES]
+
+    def close(self):
+        self.f.close()
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from nimodipine.combining import combine_letters
+
+
+class Command(BaseCommand):
+    help = """Combine letters not yet combined into PDFs for printing"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=None,
+            help="If set, write PDFs of up to this many letters each",
+        )
+        parser.add_argument(
+            "--by-postcode",
+            action="store_true",
+            help="If set, order letters by the practice's postcode",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=None,
+            help="Number of Ghostscripts to run at once (default: one per core)",
+        )
+
+    def handle(self, *args, **options):
+        outputs = combine_letters(
+            batch_size=options["batch_size"],
+            by_postcode=options["by_postcode"],
+            workers=options["workers"],
+        )
+        for output in outputs:
+            self.stdout.write("Letters combined into {}".format(output))
+        if not outputs:
+            self.stdout.write("No new letters to combine")
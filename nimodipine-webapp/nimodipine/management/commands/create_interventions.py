@@ -1,41 +1,270 @@
 import csv
+import datetime
+import hashlib
+import time
 
 
 from django.core.management.base import BaseCommand
+from django.db import connection
 from django.db import transaction
 
+from psycopg2.extras import execute_values
+from psycopg2.extras import Json
+
+from common.utils import nhs_titlecase_all
+from common.utils import normalise_fax
 from nimodipine.models import Intervention
 from nimodipine.models import InterventionContact
 
 
+# Spreadsheet columns that we store, and so which a reload should notice
+# changes in
+SOURCE_COLUMNS = [
+    "practice",
+    "practice_name",
+    "address1",
+    "address2",
+    "address3",
+    "address4",
+    "postcode",
+    "merged emails",
+    "merged faxes",
+    "value",
+]
+
+
+def contact_hash(contact):
+    """Fingerprint a row of the contacts spreadsheet
+    """
+    row = "\x1f".join(contact[column] or "" for column in SOURCE_COLUMNS)
+    return hashlib.sha1(row.encode("utf8")).hexdigest()
+
+
+def contact_fields(contact):
+    """Map a row of the contacts spreadsheet to InterventionContact fields
+    """
+    return {
+        "practice_id": contact["practice"],
+        "name": contact["practice_name"],
+        "address1": contact["address1"],
+        "address2": contact["address2"],
+        "address3": contact["address3"],
+        "address4": contact["address4"],
+        "postcode": contact["postcode"],
+        "email": contact["merged emails"],
+        "fax": contact["merged faxes"],
+        "source_hash": contact_hash(contact),
+    }
+
+
+def load_contacts(contacts, methods):
+    """Create each contact and its interventions one row at a time
+    """
+    for contact in contacts:
+        InterventionContact.objects.create(**contact_fields(contact))
+        for method in methods:
+            Intervention.objects.create(
+                method=method,
+                practice_id=contact["practice"],
+                contact_id=contact["practice"],
+                metadata={"value": contact["value"]},
+            )
+
+
+def bulk_load_contacts(contacts, methods, batch_size):
+    """Create all contacts and interventions with batched INSERTs.
+
+    `bulk_create` doesn't call `save()`, so fax numbers are normalised
+    and names cased here in a single pass over the spreadsheet instead.
+    """
+    normalised_faxes = [normalise_fax(contact["merged faxes"]) for contact in contacts]
+    cased_names = nhs_titlecase_all([contact["practice_name"] for contact in contacts])
+    InterventionContact.objects.bulk_create(
+        [
+            InterventionContact(
+                normalised_fax=normalised_fax,
+                cased_name=cased_name,
+                **contact_fields(contact)
+            )
+            for contact, normalised_fax, cased_name in zip(
+                contacts, normalised_faxes, cased_names
+            )
+        ],
+        batch_size=batch_size,
+    )
+    Intervention.objects.bulk_create(
+        [
+            Intervention(
+                method=method,
+                practice_id=contact["practice"],
+                contact_id=contact["practice"],
+                metadata={"value": contact["value"]},
+            )
+            for contact in contacts
+            for method in methods
+        ],
+        batch_size=batch_size,
+    )
+
+
+def upsert_contacts(contacts, methods, batch_size):
+    """Apply only the differences between the contacts spreadsheet and the
+    database, leaving the state of existing interventions (hits, sent,
+    receipt etc) intact.
+
+    Rows whose hash matches what is stored are skipped; new and changed
+    rows are upserted on `practice_id`; contacts no longer in the
+    spreadsheet are marked as retired rather than deleted.
+
+    Returns a tuple of (inserted, updated, retired) counts.
+    """
+    stored = {
+        practice_id: (source_hash, retired)
+        for practice_id, source_hash, retired in InterventionContact.objects.values_list(
+            "practice_id", "source_hash", "retired"
+        )
+    }
+    changed = [
+        contact
+        for contact in contacts
+        if stored.get(contact["practice"]) != (contact_hash(contact), False)
+    ]
+    seen = set(contact["practice"] for contact in contacts)
+    to_retire = [
+        practice_id
+        for practice_id, (_, retired) in stored.items()
+        if practice_id not in seen and not retired
+    ]
+    contact_rows = []
+    intervention_rows = []
+    today = datetime.date.today()
+    cased_names = nhs_titlecase_all([contact["practice_name"] for contact in changed])
+    for contact, cased_name in zip(changed, cased_names):
+        fields = contact_fields(contact)
+        contact_rows.append(
+            (
+                fields["practice_id"],
+                fields["name"],
+                cased_name,
+                fields["address1"],
+                fields["address2"],
+                fields["address3"],
+                fields["address4"],
+                fields["postcode"],
+                fields["email"],
+                fields["fax"],
+                normalise_fax(fields["fax"]),
+                fields["source_hash"],
+                False,
+                False,
+                0,
+            )
+        )
+        for method in methods:
+            intervention_rows.append(
+                (
+                    today,
+                    method,
+                    contact["practice"],
+                    contact["practice"],
+                    Json({"value": contact["value"]}),
+                    0,
+                    False,
+                    False,
+                )
+            )
+    with connection.cursor() as cursor:
+        execute_values(
+            cursor,
+            """
+            INSERT INTO {table} (
+              practice_id, name, cased_name, address1, address2, address3,
+              address4, postcode, email, fax, normalised_fax, source_hash,
+              blacklisted, retired, hits
+            ) VALUES %s
+            ON CONFLICT (practice_id) DO UPDATE SET
+              name = EXCLUDED.name,
+              cased_name = EXCLUDED.cased_name,
+              address1 = EXCLUDED.address1,
+              address2 = EXCLUDED.address2,
+              address3 = EXCLUDED.address3,
+              address4 = EXCLUDED.address4,
+              postcode = EXCLUDED.postcode,
+              email = EXCLUDED.email,
+              fax = EXCLUDED.fax,
+              normalised_fax = EXCLUDED.normalised_fax,
+              source_hash = EXCLUDED.source_hash,
+              retired = EXCLUDED.retired
+            """.format(
+                table=InterventionContact._meta.db_table
+            ),
+            contact_rows,
+            page_size=batch_size,
+        )
+        execute_values(
+            cursor,
+            """
+            INSERT INTO {table} (
+              created_date, method, practice_id, contact_id, metadata,
+              hits, sent, generated
+            ) VALUES %s
+            ON CONFLICT (method, practice_id) DO UPDATE SET
+              metadata = EXCLUDED.metadata
+            WHERE {table}.metadata IS DISTINCT FROM EXCLUDED.metadata
+            """.format(
+                table=Intervention._meta.db_table
+            ),
+            intervention_rows,
+            page_size=batch_size,
+        )
+    InterventionContact.objects.filter(practice_id__in=to_retire).update(retired=True)
+    inserted = len([x for x in changed if x["practice"] not in stored])
+    return inserted, len(changed) - inserted, len(to_retire)
+
+
 class Command(BaseCommand):
     help = """Load interventions from practice contact list"""
 
     def add_arguments(self, parser):
         parser.add_argument("--contacts", required=True)
+        parser.add_argument(
+            "--bulk",
+            action="store_true",
+            help="If set, load contacts and interventions with batched INSERTs",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of rows per INSERT when loading in bulk",
+        )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="If set, only insert, update or retire contacts which have "
+            "changed since the last load, rather than replacing them all",
+        )
 
     def handle(self, *args, **options):
         methods = [x[0] for x in Intervention.METHOD_CHOICES]
+        start = time.time()
+        with open(options["contacts"], "r") as f:
+            contacts = list(csv.DictReader(f))
         with transaction.atomic():
-            if options["contacts"]:
+            if options["incremental"]:
+                counts = upsert_contacts(contacts, methods, options["batch_size"])
+                self.stdout.write(
+                    "{} contacts inserted, {} updated, {} retired".format(*counts)
+                )
+            elif options["bulk"]:
+                InterventionContact.objects.all().delete()
+                bulk_load_contacts(contacts, methods, options["batch_size"])
+            else:
                 InterventionContact.objects.all().delete()
-                with open(options["contacts"], "r") as f:
-                    for contact in csv.DictReader(f):
-                        InterventionContact.objects.create(
-                            practice_id=contact["practice"],
-                            name=contact["practice_name"],
-                            address1=contact["address1"],
-                            address2=contact["address2"],
-                            address3=contact["address3"],
-                            address4=contact["address4"],
-                            postcode=contact["postcode"],
-                            email=contact["merged emails"],
-                            fax=contact["merged faxes"],
-                        )
-                        for method in methods:
-                            Intervention.objects.create(
-                                method=method,
-                                practice_id=contact["practice"],
-                                contact_id=contact["practice"],
-                                metadata={"value": contact["value"]},
-                            )
+                load_contacts(contacts, methods)
+        elapsed = time.time() - start
+        self.stdout.write(
+            "Loaded {} contacts in {:.2f}s ({:.0f} rows/sec)".format(
+                len(contacts), elapsed, len(contacts) / elapsed if elapsed else 0
+            )
+        )
@@ -0,0 +1,36 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from nimodipine.clicks import flush_click_log
+
+
+class Command(BaseCommand):
+    help = """Apply clicks logged to CLICK_LOG_PATH to the database"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=float,
+            help="If set, keep running, flushing the log every this many seconds",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of rows to write in each INSERT or UPDATE",
+        )
+
+    def handle(self, *args, **options):
+        if not settings.CLICK_LOG_PATH:
+            raise CommandError("CLICK_LOG_PATH is not set")
+        while True:
+            applied = flush_click_log(
+                settings.CLICK_LOG_PATH, batch_size=options["batch_size"]
+            )
+            self.stdout.write("{} clicks applied".format(applied))
+            if not options["interval"]:
+                break
+            time.sleep(options["interval"])
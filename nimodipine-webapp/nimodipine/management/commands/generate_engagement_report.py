@@ -0,0 +1,102 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from nimodipine.management.commands.generate_report import report_path
+from nimodipine.management.commands.generate_report import write_report
+from nimodipine.models import Intervention
+from nimodipine.models import InterventionContact
+from nimodipine.models import MailLogRollup
+from nimodipine.models import refresh_mail_rollup
+
+
+ENGAGEMENT_COLUMNS = [
+    ("practice_id", "string"),
+    ("sent", "bool"),
+    ("delivered", "bool"),
+    ("opened", "bool"),
+    ("clicked", "bool"),
+    ("bounced", "bool"),
+    ("first_delivered", "timestamp"),
+    ("first_opened", "timestamp"),
+    ("first_clicked", "timestamp"),
+    ("first_bounced", "timestamp"),
+]
+
+
+def engagement_rows(chunk_size=2000):
+    """Yield the engagement of every email intervention, from a single
+    query joining them to the mail log rollup, read from a server-side
+    cursor a chunk at a time
+    """
+    sql = """
+      SELECT
+        i.practice_id,
+        i.sent,
+        COALESCE(r.delivered, false),
+        COALESCE(r.opened, false),
+        COALESCE(r.clicked, false),
+        COALESCE(r.bounced, false),
+        r.first_delivered,
+        r.first_opened,
+        r.first_clicked,
+        r.first_bounced
+      FROM {intervention} AS i
+      JOIN {contact} AS c ON i.contact_id = c.practice_id
+      LEFT JOIN {rollup} AS r ON LOWER(c.email) = r.recipient
+      WHERE i.method = 'e'
+      ORDER BY i.practice_id
+    """.format(
+        intervention=Intervention._meta.db_table,
+        contact=InterventionContact._meta.db_table,
+        rollup=MailLogRollup._meta.db_table,
+    )
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(sql)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield from rows
+
+
+class Command(BaseCommand):
+    help = """Report whether each email intervention was delivered, opened
+    and clicked, and when"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--output",
+            default="engagement_report.csv",
+            help="Where to write the report",
+        )
+        parser.add_argument(
+            "--format",
+            choices=["csv", "parquet"],
+            default="csv",
+            help="If parquet, write a typed Parquet file (with a .parquet "
+            "extension) instead of a CSV",
+        )
+        parser.add_argument(
+            "--gzip",
+            action="store_true",
+            help="If set, gzip the CSV report (and add .gz to its name)",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=2000,
+            help="Number of rows to fetch from the database at a time",
+        )
+
+    def handle(self, *args, **options):
+        refresh_mail_rollup()
+        path = report_path(options["output"], options["format"], options["gzip"])
+        write_report(
+            path,
+            ENGAGEMENT_COLUMNS,
+            engagement_rows(options["chunk_size"]),
+            options["format"],
+            options["gzip"],
+            options["chunk_size"],
+        )
+        self.stdout.write("Engagement report written to {}".format(path))
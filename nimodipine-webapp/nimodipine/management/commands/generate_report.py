@@ -1,10 +1,66 @@
 import csv
+import gzip
+import itertools
+import os
 
 
 from django.core.management.base import BaseCommand
-from django.db import transaction
+from django.core.management.base import CommandError
+from django.db import connection
 from nimodipine.models import Intervention
 from nimodipine.models import InterventionContact
+from nimodipine.models import MailLogRollup
+from nimodipine.models import is_contactable
+from nimodipine.models import reconcile_email_receipts
+from nimodipine.models import refresh_mail_rollup
+
+
+# Version of the reports' columns, recorded in each Parquet file's
+# metadata; bump it whenever a column changes.
+#  1: first version
+#  2: mail log report loses its `events` column, which can't be kept
+#     up to date incrementally; contacts report added; CSV lines end
+#     with \n rather than \r\n
+REPORT_SCHEMA_VERSION = "2"
+
+# Columns of each report, as (name, type) pairs. The types are used for
+# the Parquet schema; in CSVs, booleans are written as 1/0.
+INTERVENTION_COLUMNS = [
+    ("practice_id", "string"),
+    ("method", "string"),
+    ("contactable", "bool"),
+    ("sent", "bool"),
+    ("delivery_success", "bool"),
+    ("hits", "int32"),
+]
+QUESTIONNAIRE_COLUMNS = [("practice_id", "string"), ("answer", "bool")]
+CONTACT_COLUMNS = [
+    ("practice_id", "string"),
+    ("name", "string"),
+    ("address1", "string"),
+    ("address2", "string"),
+    ("address3", "string"),
+    ("address4", "string"),
+    ("postcode", "string"),
+    ("email", "string"),
+    ("fax", "string"),
+    ("normalised_fax", "string"),
+    ("blacklisted", "bool"),
+    ("retired", "bool"),
+    ("survey_response", "bool"),
+    ("hits", "int32"),
+]
+MAILLOG_COLUMNS = [
+    ("recipient", "string"),
+    ("delivered", "bool"),
+    ("opened", "bool"),
+    ("clicked", "bool"),
+    ("bounced", "bool"),
+    ("first_delivered", "timestamp"),
+    ("first_opened", "timestamp"),
+    ("first_clicked", "timestamp"),
+    ("first_bounced", "timestamp"),
+]
 
 
 def numeric_truth(val):
@@ -16,43 +72,220 @@ def numeric_truth(val):
         return None
 
 
+def open_report(path, compress=False):
+    if compress:
+        return gzip.open(path, "wt", newline="")
+    return open(path, "w", newline="")
+
+
+def intervention_rows(chunk_size=2000):
+    """Yield one row per intervention, streaming them from a server-side
+    cursor so memory use doesn't grow with the number of interventions
+    """
+    rows = Intervention.objects.values_list(
+        "practice_id", "method", "contact__email", "sent", "receipt", "hits"
+    ).iterator(chunk_size=chunk_size)
+    for practice_id, method, email, sent, receipt, hits in rows:
+        yield (practice_id, method, is_contactable(method, email), sent, receipt, hits)
+
+
+def questionnaire_rows(chunk_size=2000):
+    return (
+        InterventionContact.objects.order_by("practice_id")
+        .values_list("practice_id", "survey_response")
+        .iterator(chunk_size=chunk_size)
+    )
+
+
+def contact_rows(chunk_size=2000):
+    return (
+        InterventionContact.objects.order_by("practice_id")
+        .values_list(*[name for name, _ in CONTACT_COLUMNS])
+        .iterator(chunk_size=chunk_size)
+    )
+
+
+def maillog_rows(chunk_size=2000):
+    return (
+        MailLogRollup.objects.order_by("recipient")
+        .values_list(*[name for name, _ in MAILLOG_COLUMNS])
+        .iterator(chunk_size=chunk_size)
+    )
+
+
+def write_csv(f, columns, rows):
+    # Line endings as postgres writes them for the questionnaire report
+    writer = csv.writer(f, lineterminator="\n")
+    writer.writerow([name for name, _ in columns])
+    for row in rows:
+        writer.writerow(
+            [
+                numeric_truth(value) if column_type == "bool" else value
+                for value, (_, column_type) in zip(row, columns)
+            ]
+        )
+
+
+def write_questionnaire_csv(f):
+    """Write one row per contact, straight from postgres with COPY
+    """
+    sql = """
+      COPY (
+        SELECT practice_id, survey_response::int AS answer
+        FROM {contact}
+        ORDER BY practice_id
+      ) TO STDOUT WITH CSV HEADER
+    """.format(
+        contact=InterventionContact._meta.db_table
+    )
+    with connection.cursor() as cursor:
+        cursor.copy_expert(sql, f)
+
+
+def write_parquet(path, columns, rows, chunk_size=2000):
+    """Write rows to a Parquet file with a fixed schema, a chunk at a
+    time. Booleans and nulls are preserved as such.
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise CommandError(
+            "Writing Parquet requires pyarrow: "
+            "pip install -r requirements-parquet.txt"
+        )
+    types = {
+        "string": pyarrow.string(),
+        "bool": pyarrow.bool_(),
+        "int32": pyarrow.int32(),
+        "int64": pyarrow.int64(),
+        "timestamp": pyarrow.timestamp("us", tz="UTC"),
+    }
+    schema = pyarrow.schema(
+        [(name, types[column_type]) for name, column_type in columns],
+        metadata={"nimodipine_report_schema": REPORT_SCHEMA_VERSION},
+    )
+    writer = pyarrow.parquet.ParquetWriter(path, schema)
+    try:
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            arrays = [
+                pyarrow.array(values, type=field.type)
+                for values, field in zip(zip(*chunk), schema)
+            ]
+            writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+    finally:
+        writer.close()
+
+
+def report_path(path, fmt="csv", compress=False):
+    """Adjust a report's path to suit its format"""
+    if fmt == "parquet":
+        return os.path.splitext(path)[0] + ".parquet"
+    elif compress:
+        return path + ".gz"
+    return path
+
+
+def write_report(path, columns, rows, fmt="csv", compress=False, chunk_size=2000):
+    if fmt == "parquet":
+        write_parquet(path, columns, rows, chunk_size)
+    else:
+        with open_report(path, compress) as f:
+            write_csv(f, columns, rows)
+
+
 class Command(BaseCommand):
-    help = """Create CSV report for analysis"""
+    help = """Create CSV (or Parquet) reports for analysis"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--intervention-report",
+            default="intervention_report.csv",
+            help="Where to write the intervention report",
+        )
+        parser.add_argument(
+            "--questionnaire-report",
+            default="questionnaire_report.csv",
+            help="Where to write the questionnaire report",
+        )
+        parser.add_argument(
+            "--contacts-report",
+            help="If set, also write a report of the contacts here",
+        )
+        parser.add_argument(
+            "--maillog-report",
+            help="If set, also write a per-recipient summary of the mail logs here",
+        )
+        parser.add_argument(
+            "--format",
+            choices=["csv", "parquet"],
+            default="csv",
+            help="If parquet, write typed Parquet files (with a .parquet "
+            "extension) instead of CSVs",
+        )
+        parser.add_argument(
+            "--gzip",
+            action="store_true",
+            help="If set, gzip the CSV reports (and add .gz to their names)",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=2000,
+            help="Number of rows to fetch from the database at a time",
+        )
 
     def handle(self, *args, **options):
-        needs_update = Intervention.objects.filter(receipt__isnull=True, sent=True)
-        for intervention in needs_update:
-            # This sets the receipt status of the email based on the mailgun logs
-            intervention.set_receipt()
-
-        f = open("intervention_report.csv", "w")
-        writer = csv.writer(f)
-        header = [
-            "practice_id",
-            "method",
-            "contactable",
-            "sent",
-            "delivery_success",
-            "hits",
+        # This sets the receipt status of emails based on the mailgun logs
+        refresh_mail_rollup()
+        updated = reconcile_email_receipts()
+        print("Receipt status set for {} emails".format(updated))
+
+        chunk_size = options["chunk_size"]
+        reports = [
+            (
+                "Intervention",
+                options["intervention_report"],
+                INTERVENTION_COLUMNS,
+                lambda: intervention_rows(chunk_size),
+            ),
+            (
+                "Questionnaire",
+                options["questionnaire_report"],
+                QUESTIONNAIRE_COLUMNS,
+                lambda: questionnaire_rows(chunk_size),
+            ),
+            (
+                "Contacts",
+                options["contacts_report"],
+                CONTACT_COLUMNS,
+                lambda: contact_rows(chunk_size),
+            ),
+            (
+                "Mail log",
+                options["maillog_report"],
+                MAILLOG_COLUMNS,
+                lambda: maillog_rows(chunk_size),
+            ),
         ]
-        writer.writerow(header)
-        for i in Intervention.objects.all():
-            row = [
-                i.practice_id,
-                i.method,
-                numeric_truth(i.contactable()),
-                numeric_truth(i.sent),
-                numeric_truth(i.receipt),
-                i.hits,
-            ]
-            writer.writerow(row)
-        print("Intervention report written to {}".format(f.name))
-
-        f = open("questionnaire_report.csv", "w")
-        writer = csv.writer(f)
-        header = ["practice_id", "answer"]
-        writer.writerow(header)
-        for i in InterventionContact.objects.all():
-            row = [i.practice_id, numeric_truth(i.survey_response)]
-            writer.writerow(row)
-        print("Questionnaire report written to {}".format(f.name))
+        for name, path, columns, rows in reports:
+            if not path:
+                continue
+            path = report_path(path, options["format"], options["gzip"])
+            if name == "Questionnaire" and options["format"] == "csv":
+                with open_report(path, options["gzip"]) as f:
+                    write_questionnaire_csv(f)
+            else:
+                write_report(
+                    path,
+                    columns,
+                    rows(),
+                    options["format"],
+                    options["gzip"],
+                    chunk_size,
+                )
+            print("{} report written to {}".format(name, path))
@@ -1,23 +1,35 @@
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
 import io
 import json
 import logging
-import fnmatch
 import os
-import requests
 import subprocess
+import tempfile
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
 from django.db import transaction
-from django.urls import reverse
 
 from google.cloud import bigquery
 from google.api_core.exceptions import NotFound
 
-from premailer import Premailer
-
+from common import renderer
+from nimodipine.combining import combine_letters
+from nimodipine.journal import Journal
+from nimodipine.manifest import artefact_paths
+from nimodipine.manifest import open_manifest
+from nimodipine.manifest import record_artefact
 from nimodipine.models import Intervention
 from nimodipine.models import InterventionContact
+from nimodipine.rendering import email_template_version
+from nimodipine.rendering import make_chart
+from nimodipine.rendering import make_charts
+from nimodipine.rendering import render_email_message
+from nimodipine.rendering import render_intervention_message
+from nimodipine.rendering import write_atomically
+from common.utils import email_as_text
 from common.utils import not_empty
 
 
@@ -25,40 +37,13 @@ logger = logging.getLogger(__name__)
 
 
 def capture_html(url, target_path):
+    if renderer.render({"format": "pdf", "url": url, "output": target_path}):
+        return
     cmd = '{cmd} "{url}" {target_path}'
     cmd = cmd.format(cmd=settings.PRINT_CMD, url=url, target_path=target_path)
     subprocess.check_output(cmd, shell=True)
 
 
-def find(pattern, path):
-    result = []
-    for root, dirs, files in os.walk(path):
-        for name in files:
-            if fnmatch.fnmatch(name, pattern):
-                result.append(os.path.join(root, name))
-    return result
-
-
-def combine_letters():
-    """Combine all the letters into 1 PDF to make it easier to print
-
-    """
-    inputs = find("letter.pdf", settings.DATA_DIR)
-    if inputs:
-        subprocess.check_call(
-            [
-                "gs",
-                "-q",
-                "-sPAPERSIZE=letter",
-                "-dNOPAUSE",
-                "-dBATCH",
-                "-sDEVICE=pdfwrite",
-                "-sOutputFile={}/combined_letters.pdf".format(settings.DATA_DIR),
-            ]
-            + inputs
-        )
-
-
 def count_expected():
     """Check expected number of interventions generated against number on
     filesystem
@@ -66,8 +51,9 @@ def count_expected():
     generated_count = 0
     not_generated = []
     count = Intervention.objects.count()
+    generated_paths = manifest_paths()
     for intervention in Intervention.objects.all():
-        if intervention.is_generated():
+        if intervention.is_generated(generated_paths):
             generated_count += 1
         else:
             not_generated.append(intervention)
@@ -77,6 +63,143 @@ def count_expected():
         print(not_generated)
 
 
+def manifest_paths():
+    """Return the set of message paths in the manifest, or None if there
+    isn't one
+    """
+    manifest = open_manifest()
+    if manifest:
+        paths = set(artefact_paths(manifest))
+        manifest.close()
+        return paths
+
+
+def can_generate(intervention):
+    """Do we have the contact details needed to generate a message for
+    this intervention?
+    """
+    contact = intervention.contact
+    if intervention.method == "e":  # email
+        return not_empty(contact.email)
+    elif intervention.method == "f":  # fax
+        return not_empty(contact.normalised_fax)
+    elif intervention.method == "p":  # printed letter
+        return bool(contact.address1)
+    return False
+
+
+def generate_message(intervention, encoded_image=None, template_version=None):
+    """Render the message for an intervention to its message path.
+
+    The HTML is rendered in-process, so no web server is needed.  This
+    doesn't touch the database, so it is safe to call from worker
+    threads; the caller is responsible for marking the intervention as
+    generated.
+    """
+    destination = intervention.message_path()
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    if intervention.method == "e":
+        logger.info("Creating email at {}".format(destination))
+        html = render_email_message(intervention, encoded_image, template_version)
+        write_atomically(destination, html.encode("utf8"))
+        # Done here, so sending doesn't have to
+        text_path = os.path.join(os.path.dirname(destination), "email.txt")
+        write_atomically(text_path, email_as_text(html).encode("utf8"))
+    else:
+        html = render_intervention_message(intervention, encoded_image)
+        if intervention.method == "f":
+            logger.info("Creating fax at {}".format(destination))
+        else:
+            logger.info("Creating postal letter at {}".format(destination))
+        # Render alongside, then rename, so a half-written PDF is never
+        # mistaken for a message
+        fd, pdf_path = tempfile.mkstemp(suffix=".pdf", dir=os.path.dirname(destination))
+        os.close(fd)
+        try:
+            with tempfile.NamedTemporaryFile("w", suffix=".html", encoding="utf8") as f:
+                f.write(html)
+                f.flush()
+                capture_html("file://" + f.name, pdf_path)
+            os.replace(pdf_path, destination)
+        finally:
+            if os.path.exists(pdf_path):
+                os.remove(pdf_path)
+
+
+def generate_messages(interventions, workers=1, journal=None):
+    """Generate messages for the given interventions, using up to
+    `workers` threads (rendering is dominated by waiting on PhantomJS,
+    so threads are enough).
+
+    Charts for all the interventions are drawn up front, once per
+    distinct chart.  A failure to generate one message (including its
+    chart) is logged and doesn't stop the others.  Each intervention is
+    marked as generated, and its message
+    recorded in the manifest (and in `journal`, if given), from the
+    calling thread as soon as its message has been written.
+
+    Returns a tuple of (generated, failed) counts.
+    """
+    total = len(interventions)
+    generated = 0
+    failed = 0
+    charts = make_charts((x.id, (x.metadata or {}).get("value")) for x in interventions)
+    # Only created once there's something to record in it
+    manifest = None
+    template_version = email_template_version()
+
+    def generate(intervention):
+        encoded_image = charts.get(intervention.id)
+        if encoded_image is None:
+            # Draw it here, so that the error is this message's alone
+            encoded_image = make_chart(intervention.metadata["value"])
+        generate_message(intervention, encoded_image, template_version)
+
+    for intervention, error in _map_isolated(generate, interventions, workers):
+        if error:
+            logger.error("Failed to generate %s", intervention, exc_info=error)
+            failed += 1
+            if journal:
+                journal.record(intervention.pk, "failed")
+        else:
+            if manifest is None:
+                manifest = open_manifest(create=True)
+            record_artefact(manifest, intervention, intervention.message_path())
+            Intervention.objects.filter(pk=intervention.pk).update(generated=True)
+            intervention.generated = True
+            generated += 1
+            if journal:
+                journal.record(intervention.pk, "done")
+        logger.info(
+            "Progress: %s of %s messages done (%s failed)",
+            generated + failed,
+            total,
+            failed,
+        )
+    if manifest:
+        manifest.close()
+    return generated, failed
+
+
+def _map_isolated(func, items, workers):
+    """Yield `(item, exception)` as `func(item)` completes for each item,
+    where `exception` is None if it succeeded
+    """
+    if workers <= 1:
+        for item in items:
+            try:
+                func(item)
+            except Exception as e:
+                yield item, e
+            else:
+                yield item, None
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(func, item): item for item in items}
+        for future in as_completed(futures):
+            yield futures[future], future.exception()
+
+
 class Command(BaseCommand):
     help = """Load interventions from practice allocations"""
 
@@ -99,63 +222,88 @@ class Command(BaseCommand):
             default=None,
             help="If set, generate messages for only this practice",
         )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of messages to generate concurrently",
+        )
+        parser.add_argument(
+            "--letter-batch-size",
+            type=int,
+            default=None,
+            help="If set, combine new letters into PDFs of this many letters",
+        )
+        parser.add_argument(
+            "--by-postcode",
+            action="store_true",
+            help="If set, order combined letters by postcode",
+        )
+        parser.add_argument(
+            "--resume",
+            type=str,
+            default=None,
+            metavar="RUN_ID",
+            help="If set, generate only the messages an earlier run didn't, "
+            "instead of finding which are needed",
+        )
 
     def handle(self, *args, **options):
-        interventions = Intervention.objects.filter(contact__blacklisted=False)
+        if options["resume"]:
+            try:
+                journal = Journal.resume(options["resume"], "generate_wave")
+            except ValueError as e:
+                raise CommandError(str(e))
+            pks = journal.pending()
+            interventions = Intervention.objects.select_related("contact").in_bulk(pks)
+            pending = [interventions[pk] for pk in pks if pk in interventions]
+        else:
+            pending = self.find_pending(options)
+            journal = Journal.start(
+                "generate_wave",
+                [x.pk for x in pending],
+                method=options["method"],
+                practice=options["practice"],
+                sample=options["sample"],
+            )
+        self.stdout.write("Run ID: {}".format(journal.run_id))
+        try:
+            generated, failed = generate_messages(
+                pending, workers=options["workers"], journal=journal
+            )
+        finally:
+            journal.close()
+        combine_letters(
+            batch_size=options["letter_batch_size"], by_postcode=options["by_postcode"]
+        )
+        count_expected()
+        if failed:
+            raise CommandError(
+                "{} of {} messages failed to generate; to retry them, "
+                "run with --resume={}".format(failed, len(pending), journal.run_id)
+            )
+
+    def find_pending(self, options):
+        """Return the interventions that need a message generating
+        """
+        interventions = Intervention.objects.filter(
+            contact__blacklisted=False, contact__retired=False
+        ).select_related("contact")
         if options["method"]:
             interventions = interventions.filter(method=options["method"])
         if options["practice"]:
             interventions = interventions.filter(practice_id=options["practice"])
         if options["sample"]:
             interventions = interventions.order_by("?")
-        saved = 0
+        pending = []
+        generated_paths = manifest_paths()
         for intervention in interventions:
-            if options["sample"] and saved >= options["sample"]:
+            if options["sample"] and len(pending) >= options["sample"]:
                 break
-            if intervention.is_generated():
+            if intervention.is_generated(generated_paths):
                 logger.info("Skipping generating %s as already done", intervention)
-                continue
-            contact = intervention.contact
-            message_url = settings.URL_ROOT + reverse(
-                "views.intervention_message", args=[intervention.id]
-            )
-            destination = intervention.message_path()
-            if intervention.method == "e" and not_empty(contact.email):  # email
-                logger.info(
-                    "Creating email at {} via URL {}".format(destination, message_url)
-                )
-                response = requests.get(message_url)
-                if response.status_code != requests.codes.ok:
-                    raise Exception(
-                        "bad response when trying to get {}".format(message_url)
-                    )
-                html = Premailer(
-                    response.content.decode("utf-8"),
-                    cssutils_logging_level=logging.ERROR,
-                ).transform()
-                with open(destination, "w") as f:
-                    f.write(html)
-                intervention.generated = True
-                intervention.save()
-                saved += 1
-            elif intervention.method == "f" and not_empty(
-                contact.normalised_fax
-            ):  # fax
-                logger.info(
-                    "Creating fax at {} via URL {}".format(destination, message_url)
-                )
-                capture_html(message_url, destination)
-                intervention.generated = True
-                intervention.save()
-                saved += 1
-            elif intervention.method == "p" and contact.address1:  # printed letter
-                base = intervention.message_dir()
-                logger.info("Creating postal letter at {}".format(base))
-                capture_html(message_url, destination)
-                intervention.generated = True
-                intervention.save()
-                saved += 1
+            elif can_generate(intervention):
+                pending.append(intervention)
             else:
                 logger.info("No valid contact info: %s", intervention)
-        combine_letters()
-        count_expected()
+        return pending
@@ -0,0 +1,67 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from nimodipine.management.commands.send_messages import interfax_client
+from nimodipine.models import Intervention
+from nimodipine.models import fax_status_receipt
+
+
+logger = logging.getLogger(__name__)
+
+
+def reconcile_fax_receipts(interfax, batch_size=100):
+    """Ask InterFAX for the status of every sent fax we haven't had a
+    delivery callback for, and record the outcome of those which have
+    completed.
+
+    Returns a tuple of (delivered, failed, skipped) counts, where
+    skipped faxes are those whose status couldn't be read.
+    """
+    pending = Intervention.objects.filter(
+        method="f", sent=True, receipt__isnull=True, fax_id__isnull=False
+    )
+    fax_ids = list(pending.values_list("fax_id", flat=True))
+    delivered = []
+    failed = []
+    skipped = 0
+    for i in range(0, len(fax_ids), batch_size):
+        # Faxes which haven't completed yet aren't returned
+        for fax in interfax.outbound.completed(*fax_ids[i : i + batch_size]):
+            try:
+                receipt = fax_status_receipt(fax.status)
+            except (TypeError, ValueError):
+                logger.warning(
+                    "Skipping fax %s with unreadable status %r", fax.id, fax.status
+                )
+                skipped += 1
+                continue
+            if receipt is True:
+                delivered.append(str(fax.id))
+            elif receipt is False:
+                failed.append(str(fax.id))
+    pending.filter(fax_id__in=delivered).update(receipt=True)
+    pending.filter(fax_id__in=failed).update(receipt=False)
+    return len(delivered), len(failed), skipped
+
+
+class Command(BaseCommand):
+    help = """Record delivery status of sent faxes whose callbacks never arrived"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Number of faxes to ask InterFAX about in each request",
+        )
+
+    def handle(self, *args, **options):
+        delivered, failed, skipped = reconcile_fax_receipts(
+            interfax_client(), options["batch_size"]
+        )
+        self.stdout.write("{} faxes delivered, {} failed".format(delivered, failed))
+        if skipped:
+            self.stdout.write(
+                "{} faxes with unreadable statuses skipped".format(skipped)
+            )
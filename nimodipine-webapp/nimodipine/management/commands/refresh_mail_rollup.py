@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from nimodipine.models import refresh_mail_rollup
+
+
+class Command(BaseCommand):
+    help = """Summarise new nimodipine mail logs into MailLogRollup"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="If set, re-read all the mail logs, not just those since the "
+            "last refresh",
+        )
+
+    def handle(self, *args, **options):
+        updated = refresh_mail_rollup(full=options["full"])
+        self.stdout.write("{} recipients updated".format(updated))
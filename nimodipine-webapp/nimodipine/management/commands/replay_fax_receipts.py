@@ -0,0 +1,73 @@
+import csv
+import logging
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from common.utils import normalise_fax
+from nimodipine.models import fax_status_receipt
+from nimodipine.models import set_fax_receipts
+
+logger = logging.getLogger(__name__)
+
+
+def read_fax_statuses(f, fax_column, status_column):
+    """Return a dict of the final status of each fax number in a CSV of
+    fax status records, such as an export from InterFAX, and the number
+    of records skipped because their status couldn't be read.
+
+    Later records override earlier ones, as they would have if they'd
+    arrived as callbacks in that order. Temporary statuses are ignored.
+    """
+    statuses = {}
+    skipped = 0
+    for line, row in enumerate(csv.DictReader(f), 2):
+        try:
+            fax, status = row[fax_column], row[status_column]
+        except KeyError as e:
+            raise CommandError("No {} column in the CSV".format(e))
+        try:
+            receipt = fax_status_receipt(status)
+        except (TypeError, ValueError):
+            logger.warning("Skipping line %s with unreadable status %r", line, status)
+            skipped += 1
+            continue
+        if receipt is not None:
+            statuses[normalise_fax(fax)] = receipt
+    return statuses, skipped
+
+
+class Command(BaseCommand):
+    help = """Apply many fax status records at once, as if each had arrived
+    via the fax_receipt callback"""
+
+    def add_arguments(self, parser):
+        parser.add_argument("--csv", required=True, help="CSV of fax statuses")
+        parser.add_argument(
+            "--fax-column",
+            default="DestinationFax",
+            help="Name of the column holding the destination fax number",
+        )
+        parser.add_argument(
+            "--status-column",
+            default="Status",
+            help="Name of the column holding the InterFAX status code",
+        )
+
+    def handle(self, *args, **options):
+        with open(options["csv"], newline="") as f:
+            statuses, skipped = read_fax_statuses(
+                f, options["fax_column"], options["status_column"]
+            )
+        for receipt in [True, False]:
+            faxes = [fax for fax, status in statuses.items() if status is receipt]
+            ids = set_fax_receipts(faxes, receipt)
+            self.stdout.write(
+                "{} interventions marked as {}".format(
+                    len(ids), "received" if receipt else "failed"
+                )
+            )
+        if skipped:
+            self.stdout.write(
+                "{} records with unreadable statuses skipped".format(skipped)
+            )
@@ -0,0 +1,56 @@
+import logging
+import shlex
+import subprocess
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+logger = logging.getLogger(__name__)
+
+
+def start_renderer(port):
+    cmd = shlex.split(settings.RENDER_SERVER_CMD) + [str(port)]
+    return subprocess.Popen(cmd)
+
+
+class Command(BaseCommand):
+    help = """Run a pool of long-lived PhantomJS renderers, for use by
+    generate_wave via the RENDERER_URLS setting"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=4, help="Number of renderers to run"
+        )
+        parser.add_argument(
+            "--port",
+            type=int,
+            default=8910,
+            help="Port for the first renderer; the others use the ports after it",
+        )
+
+    def handle(self, *args, **options):
+        ports = range(options["port"], options["port"] + options["workers"])
+        renderers = {port: start_renderer(port) for port in ports}
+        urls = ["http://127.0.0.1:{}/".format(port) for port in ports]
+        self.stdout.write(
+            "Started {} renderers. Use them with:\n\n"
+            "    export RENDERER_URLS={}\n".format(len(urls), ",".join(urls))
+        )
+        try:
+            while True:
+                time.sleep(1)
+                for port, process in list(renderers.items()):
+                    if process.poll() is not None:
+                        logger.warning(
+                            "Renderer on port %s exited with status %s; restarting",
+                            port,
+                            process.returncode,
+                        )
+                        renderers[port] = start_renderer(port)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for process in renderers.values():
+                process.terminate()
@@ -1,8 +1,18 @@
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import wait
+from functools import lru_cache
 import glob
+import hashlib
+import itertools
 import json
 import logging
 import os
+import queue
 import re
+import smtplib
+import threading
+import time
 
 from email.mime.image import MIMEImage
 from email.utils import unquote
@@ -10,7 +20,7 @@ from email.utils import unquote
 from django.conf import settings
 from django.core.mail import EmailMessage
 from django.core.mail import EmailMultiAlternatives
-from django.core.mail import make_msgid
+from django.core.mail import get_connection
 from django.core.management.base import BaseCommand
 from django.core.management.base import CommandError
 
@@ -18,29 +28,51 @@ from anymail.message import attach_inline_image_file
 from interfax import InterFAX
 
 from common.utils import email_as_text
+from nimodipine.journal import Journal
+from nimodipine.manifest import artefact_paths
+from nimodipine.manifest import open_manifest
 from nimodipine.models import Intervention
 from nimodipine.models import InterventionContact
+from nimodipine.rendering import static_image_filename
 
 
 logger = logging.getLogger(__name__)
 
 
+DATA_IMAGE_RE = re.compile(r'<img.*?src="data:image/png;base64,(.*?)">')
+
+# Images recur across messages (the header and footer are in every one,
+# and charts are shared by practices with similar prescribing), so each
+# MIME part is built once and attached to every message using it.
+@lru_cache(maxsize=256)
+def image_part(data):
+    """Return `(content_id, part)` for an inline image, given its base64
+    encoding
+    """
+    digest = hashlib.sha1(data.encode("ascii")).hexdigest()
+    filename = static_image_filename(data) or "chart-{}.png".format(digest[:12])
+    content_id = "<{}@nimodipine>".format(digest)
+    image = MIMEImage(data, "png", _encoder=lambda x: x)
+    image.add_header("Content-Disposition", "inline", filename=filename)
+    image.add_header("Content-ID", content_id)
+    image.add_header("Content-Transfer-Encoding", "base64")
+    return content_id, image
+
+
 def inline_images(message, html):
     """Given HTML with inline data images, convert these to attachments,
     and add HTML as an alternative
     """
-    images = re.findall(r'<img.*?src="data:image/png;base64,.*?">', html)
-    for i, image_tag in enumerate(images):
-        filename = "img{}.png".format(i)
-        data = re.findall(r'<img.*?src="data:image/png;base64,(.*?)">', image_tag)[0]
-        content_id = make_msgid("img")  # Content ID per RFC 2045 section 7 (with <...>)
-        image = MIMEImage(data, "png", _encoder=lambda x: x)
-        image.add_header("Content-Disposition", "inline", filename=filename)
-        image.add_header("Content-ID", content_id)
-        image.add_header("Content-Transfer-Encoding", "base64")
-        message.attach(image)
-        html = html.replace(image_tag, '<img src="cid:{}">'.format(unquote(content_id)))
-    message.attach_alternative(html, "text/html")
+    attached = set()
+
+    def attach(match):
+        content_id, image = image_part(match.group(1))
+        if content_id not in attached:
+            attached.add(content_id)
+            message.attach(image)
+        return '<img src="cid:{}">'.format(unquote(content_id))
+
+    message.attach_alternative(DATA_IMAGE_RE.sub(attach, html), "text/html")
     return message
 
 
@@ -59,54 +91,213 @@ def get_intervention_from_path(path):
         )
 
 
-def send_email_message(msg_path, recipient=None, dry_run=False):
-    email_path = os.path.join(msg_path, "email.html")
-    with open(email_path, "r") as body_f:
-        body = body_f.read()
-        intervention = get_intervention_from_path(email_path)
-        if not intervention:
+def load_interventions(msg_paths):
+    """Return a dict of the intervention for each of `msg_paths`, looked
+    up in a single query
+    """
+    wanted = {
+        (message_method(msg_path)[0], os.path.basename(msg_path)): msg_path
+        for msg_path in msg_paths
+    }
+    interventions = {}
+    for intervention in Intervention.objects.filter(
+        practice_id__in={practice_id for _, practice_id in wanted}
+    ).select_related("contact"):
+        msg_path = wanted.get((intervention.method, intervention.practice_id))
+        if msg_path:
+            interventions[msg_path] = intervention
+    for msg_path in msg_paths:
+        if msg_path not in interventions:
+            logger.error("Could not find intervention for %s", msg_path)
+    return interventions
+
+
+def find_intervention(interventions, path):
+    """Return the intervention for the message file at `path`, from
+    `interventions` if given
+    """
+    if interventions is None:
+        return get_intervention_from_path(path)
+    return interventions.get(os.path.dirname(path))
+
+
+def build_email_message(intervention, body, recipient=None, text=None):
+    """Build the email for an intervention from its generated HTML and,
+    if it was generated alongside, plain text
+    """
+    if settings.DEBUG:
+        # Belt-and-braces to ensure we don't accidentally send to
+        # real users
+        to = settings.TEST_EMAIL_TO
+    else:
+        to = intervention.contact.email
+    if recipient:
+        # Always allow overriding the test fax recipient
+        to = recipient
+    subject = "Information about your nimodipine prescribing from OpenPrescribing.net"
+    msg = EmailMultiAlternatives(
+        subject=subject,
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[to],
+        reply_to=[settings.DEFAULT_FROM_EMAIL],
+    )
+    msg = inline_images(msg, body)
+    msg.tags = ["nimodipine"]
+    if text is None:
+        text = email_as_text(msg.alternatives[0][0])
+    msg.body = text
+    msg.track_clicks = True
+    return msg
+
+
+def read_text(msg_path):
+    """Return the plain text version of an email, or None if it wasn't
+    generated with one
+    """
+    try:
+        with open(os.path.join(msg_path, "email.txt"), "r", encoding="utf8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+# Errors meaning the connection to the email backend has gone, so that
+# the rest of a batch can't be sent over it either
+CONNECTION_ERRORS = (ConnectionError, smtplib.SMTPServerDisconnected)
+
+
+class RateLimiter:
+    """Allow at most `rate` calls to `wait()` per second, across threads
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_slot = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
             return
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        time.sleep(slot - now)
+
+
+def send_email_messages(
+    msg_paths,
+    recipient=None,
+    dry_run=False,
+    batch_size=100,
+    workers=1,
+    rate=None,
+    journal=None,
+    interventions=None,
+):
+    """Send the emails in `msg_paths` in batches, each over a single
+    backend connection, with up to `workers` batches in flight at once
+    and no more than `rate` emails sent per second.
+
+    Interventions already marked as sent are skipped, and each one is
+    marked as sent as soon as its email has been accepted by the backend,
+    so an interrupted run can safely be repeated. If given, `journal`
+    records each email as soon as it is accepted.
+
+    `interventions` is an optional dict of each message path's
+    intervention, as returned by `load_interventions()`; without it,
+    they are looked up one at a time.
+
+    Returns the number of emails sent.
+    """
+    pending = []
+    for msg_path in msg_paths:
+        email_path = os.path.join(msg_path, "email.html")
+        intervention = find_intervention(interventions, email_path)
+        if not intervention:
+            continue
         if intervention.sent:
             logger.info("Refusing to resend %s", intervention)
-            return
-        logger.info("Sending message to %s", intervention)
-        if settings.DEBUG:
-            # Belt-and-braces to ensure we don't accidentally send to
-            # real users
-            to = settings.TEST_EMAIL_TO
-        else:
-            to = intervention.contact.email
-        if recipient:
-            # Always allow overriding the test fax recipient
-            to = recipient
-        subject = (
-            "Information about your nimodipine prescribing from OpenPrescribing.net"
-        )
-        msg = EmailMultiAlternatives(
-            subject=subject,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            to=[to],
-            reply_to=[settings.DEFAULT_FROM_EMAIL],
-        )
-        msg = inline_images(msg, body)
-        msg.tags = ["nimodipine"]
-        msg.body = email_as_text(msg.alternatives[0][0])
-        msg.track_clicks = True
-        if not dry_run:
-            msg.send()
-            intervention.sent = True
-            intervention.save()
-
-
-def send_fax_message(msg_path, recipient=None, dry_run=False):
-    fax_path = os.path.join(msg_path, "fax.pdf")
-    intervention = get_intervention_from_path(fax_path)
-    if not intervention:
-        return
-    if intervention.sent:
-        logger.info("Refusing to resend %s", intervention)
-        return
-    logger.info("Sending message to %s", intervention)
+            if journal:
+                journal.record(intervention.pk, "skipped")
+            continue
+        with open(email_path, "r", encoding="utf8") as body_f:
+            msg = build_email_message(
+                intervention, body_f.read(), recipient, read_text(msg_path)
+            )
+        pending.append((intervention, msg, msg_path))
+    batches = [pending[i : i + batch_size] for i in range(0, len(pending), batch_size)]
+    limiter = RateLimiter(rate)
+    # Each accepted email, then `(None, error)` as each batch finishes
+    results = queue.Queue()
+    stop = threading.Event()
+
+    def send_batch(batch):
+        """Send a batch over one connection, reporting each email to
+        `results` as soon as it has been accepted.  An email which fails
+        is logged and the rest of the batch sent, unless the connection
+        itself has failed.
+        """
+        error = None
+        try:
+            if dry_run:
+                return
+            with get_connection() as connection:
+                for intervention, msg, msg_path in batch:
+                    limiter.wait()
+                    if stop.is_set():
+                        return
+                    logger.info("Sending message to %s", intervention)
+                    try:
+                        connection.send_messages([msg])
+                    except CONNECTION_ERRORS:
+                        raise
+                    except Exception:
+                        # Such as the provider rejecting this address; the
+                        # rest of the batch can still be sent
+                        logger.exception("Failed to send email to %s", intervention)
+                        if journal:
+                            journal.record(intervention.pk, "failed")
+                        continue
+                    if journal:
+                        journal.record(intervention.pk, "done")
+                    results.put((intervention, None))
+        except Exception as e:
+            error = e
+        finally:
+            results.put((None, error))
+
+    sent_count = 0
+    finished = 0
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = [executor.submit(send_batch, batch) for batch in batches]
+    try:
+        while finished < len(futures):
+            intervention, error = results.get()
+            if intervention:
+                Intervention.objects.filter(pk=intervention.pk).update(sent=True)
+                sent_count += 1
+                logger.info("Sent %s of %s emails", sent_count, len(pending))
+            else:
+                finished += 1
+                if error:
+                    logger.error("Failed to send a batch of emails", exc_info=error)
+    finally:
+        # If interrupted, don't start any more batches or emails, but
+        # record those sent in the meantime
+        stop.set()
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+        while not results.empty():
+            intervention, _ = results.get()
+            if intervention:
+                Intervention.objects.filter(pk=intervention.pk).update(sent=True)
+                sent_count += 1
+    return sent_count
+
+
+def fax_recipient(intervention, recipient=None):
     if settings.DEBUG:
         to = settings.TEST_FAX_TO
     else:
@@ -114,9 +305,13 @@ def send_fax_message(msg_path, recipient=None, dry_run=False):
     if recipient:
         # Always allow overriding the test fax recipient
         to = recipient
+    return to
+
+
+def fax_options():
     # Interfax has 60 character limit on subject
     subject = "about your nimodipine prescribing"
-    kwargs = {
+    return {
         "page_header": "To: {To} From: {From} Pages: {TotalPages}",
         "reference": subject,
         "reply_address": settings.FAX_FROM_EMAIL,
@@ -126,13 +321,125 @@ def send_fax_message(msg_path, recipient=None, dry_run=False):
         "rendering": "greyscale",
         "contact": "Prescribing Lead",
     }
-    interfax = InterFAX(
-        username=settings.INTERFAX_USER, password=settings.INTERFAX_PASS
-    )
-    if not dry_run:
-        interfax.deliver(to, files=[fax_path], **kwargs)
-        intervention.sent = True
-        intervention.save()
+
+
+def interfax_client():
+    return InterFAX(username=settings.INTERFAX_USER, password=settings.INTERFAX_PASS)
+
+
+def send_fax_messages(
+    msg_paths,
+    recipient=None,
+    dry_run=False,
+    workers=1,
+    journal=None,
+    interventions=None,
+):
+    """Submit the faxes in `msg_paths` to InterFAX, up to `workers` at a
+    time, through a single client.  Faxes are only handed to a worker as
+    one becomes free, so an interruption leaves none queued.
+
+    Each intervention is marked as sent, with the ID InterFAX gave its
+    fax, as soon as its fax has been accepted.  Delivery is confirmed
+    later, by the `fax_receipt` callback or `reconcile_faxes`. If given,
+    `journal` records what happened to each fax. `interventions` is as
+    for `send_email_messages()`.
+
+    Returns the number of faxes submitted.
+    """
+    pending = []
+    for msg_path in msg_paths:
+        fax_path = os.path.join(msg_path, "fax.pdf")
+        intervention = find_intervention(interventions, fax_path)
+        if not intervention:
+            continue
+        if intervention.sent:
+            logger.info("Refusing to resend %s", intervention)
+            if journal:
+                journal.record(intervention.pk, "skipped")
+            continue
+        pending.append((intervention, fax_recipient(intervention, recipient), fax_path))
+    interfax = interfax_client()
+    options = fax_options()
+
+    def deliver(item):
+        intervention, to, fax_path = item
+        logger.info("Sending message to %s", intervention)
+        if dry_run:
+            return None
+        return interfax.deliver(to, files=[fax_path], **options)
+
+    def record(future, item):
+        """Record the outcome of sending a fax, returning whether it was
+        sent
+        """
+        intervention = item[0]
+        try:
+            fax = future.result()
+        except Exception:
+            logger.exception("Failed to send fax for %s", intervention)
+            if journal:
+                journal.record(intervention.pk, "failed")
+            return False
+        if fax is None:
+            return False
+        Intervention.objects.filter(pk=intervention.pk).update(sent=True, fax_id=fax.id)
+        if journal:
+            journal.record(intervention.pk, "done")
+        return True
+
+    sent_count = 0
+    items = iter(pending)
+    in_flight = {}
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        while True:
+            # Only submit as many faxes as are sent at once, so none are
+            # left queued if we're interrupted
+            for item in itertools.islice(items, workers - len(in_flight)):
+                in_flight[executor.submit(deliver, item)] = item
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                sent_count += record(future, in_flight.pop(future))
+    finally:
+        # If interrupted, record the faxes that were already being sent
+        executor.shutdown(wait=True)
+        for future, item in in_flight.items():
+            sent_count += record(future, item)
+    logger.info("Sent %s of %s faxes", sent_count, len(pending))
+    return sent_count
+
+
+def message_method(msg_path):
+    """Return the method (`email` or `fax`) a message is for, from its path
+    """
+    return os.path.basename(os.path.dirname(msg_path))
+
+
+def find_msg_paths(methods, practice_id=None):
+    """Return the paths of the messages to send, from the manifest if
+    there is one, or otherwise by scanning DATA_DIR
+    """
+    manifest = open_manifest()
+    msg_paths = []
+    for method in methods:
+        base_path = os.path.join(settings.DATA_DIR, method)
+        if manifest:
+            msg_paths.extend(
+                os.path.dirname(path)
+                for path in artefact_paths(
+                    manifest, method=method[0], practice_id=practice_id
+                )
+            )
+        elif practice_id:
+            msg_paths.append(os.path.join(base_path, practice_id))
+        else:
+            msg_paths.extend(glob.glob(os.path.join(base_path, "*")))
+    if manifest:
+        manifest.close()
+    return msg_paths
 
 
 class Command(BaseCommand):
@@ -158,9 +465,43 @@ class Command(BaseCommand):
             default=False,
             help="If set, do not actually send anything",
         )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Number of emails to send over each connection",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of faxes, or batches of emails, to send concurrently",
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=None,
+            help="If set, send no more than this many emails per second",
+        )
+        parser.add_argument(
+            "--resume",
+            type=str,
+            default=None,
+            metavar="RUN_ID",
+            help="If set, send only the messages an earlier run didn't, with "
+            "that run's method(s), test recipient and dry run settings",
+        )
 
     def handle(self, *args, **options):
-        if options["method"]:
+        if options["resume"]:
+            try:
+                journal = Journal.resume(options["resume"], "send_messages")
+            except ValueError as e:
+                raise CommandError(str(e))
+            # Carry on exactly as the interrupted run would have
+            options.update(journal.options)
+            methods = journal.options["methods"]
+        elif options["method"]:
             methods = [options["method"]]
         else:
             methods = ["email", "fax"]
@@ -169,22 +510,64 @@ class Command(BaseCommand):
             prompt += " to test recipient {}".format(options["test_recipient"])
         prompt += ". Continue? (y/N)"
         really = input(prompt)
-        if really.strip().lower() == "y":
+        if really.strip().lower() != "y":
+            return
+        if options["resume"]:
+            # Anything the interrupted run sent but didn't get to mark as sent
+            Intervention.objects.filter(
+                pk__in=[
+                    item
+                    for item, entry in journal.entries.items()
+                    if entry["state"] == "done"
+                ]
+            ).update(sent=True)
+            by_pk = Intervention.objects.select_related("contact").in_bulk(
+                journal.pending()
+            )
+            interventions = {
+                intervention.message_dir(): intervention
+                for intervention in by_pk.values()
+            }
+        else:
+            interventions = load_interventions(
+                find_msg_paths(methods, options["practice"])
+            )
+            journal = Journal.start(
+                "send_messages",
+                [intervention.pk for intervention in interventions.values()],
+                methods=methods,
+                test_recipient=options["test_recipient"],
+                dry_run=options["dry_run"],
+            )
+        self.stdout.write("Run ID: {}".format(journal.run_id))
+        try:
             for method in methods:
-                base_path = os.path.join(settings.DATA_DIR, method)
-                if options["practice"]:
-                    practices = [os.path.join(base_path, options["practice"])]
+                method_paths = sorted(
+                    path
+                    for path, intervention in interventions.items()
+                    if intervention.method == method[0]
+                )
+                if method == "email":
+                    send_email_messages(
+                        method_paths,
+                        options["test_recipient"],
+                        options["dry_run"],
+                        batch_size=options["batch_size"],
+                        workers=options["workers"],
+                        rate=options["rate"],
+                        journal=journal,
+                        interventions=interventions,
+                    )
+                elif method == "fax":
+                    send_fax_messages(
+                        method_paths,
+                        options["test_recipient"],
+                        options["dry_run"],
+                        workers=options["workers"],
+                        journal=journal,
+                        interventions=interventions,
+                    )
                 else:
-                    practices = glob.glob(os.path.join(base_path, "*"))
-                for practice_id in practices:
-                    msg_path = os.path.join(base_path, practice_id)
-                    if method == "email":
-                        send_email_message(
-                            msg_path, options["test_recipient"], options["dry_run"]
-                        )
-                    elif method == "fax":
-                        send_fax_message(
-                            msg_path, options["test_recipient"], options["dry_run"]
-                        )
-                    else:
-                        raise CommandError("method must be 'fax' or 'email'")
+                    raise CommandError("method must be 'fax' or 'email'")
+        finally:
+            journal.close()
@@ -0,0 +1,170 @@
+"""A manifest of the messages generated in `settings.DATA_DIR`.
+
+Walking or globbing DATA_DIR (which has a directory per practice per
+method, on a network mount) costs a lot of metadata calls, so
+`generate_wave` records each message it writes in a SQLite database
+alongside them, and everything that needs to find messages reads that
+instead. When there is no manifest, callers fall back to scanning the
+filesystem; when one is first created, any messages already in
+DATA_DIR (e.g. from waves generated before there was a manifest) are
+recorded in it.
+"""
+from datetime import datetime
+import glob
+import hashlib
+import os
+import sqlite3
+
+from django.conf import settings
+
+MANIFEST_FILENAME = "manifest.sqlite3"
+
+# The method and message filename for each directory in DATA_DIR, as
+# laid out by `Intervention.message_path()`
+MESSAGE_FILES = {
+    "email": ("e", "email.html"),
+    "fax": ("f", "fax.pdf"),
+    "post": ("p", "letter.pdf"),
+}
+
+
+def manifest_path():
+    return os.path.join(settings.DATA_DIR, MANIFEST_FILENAME)
+
+
+def open_manifest(create=False):
+    """Return a connection to the manifest, or None if there isn't one
+    and `create` is False
+    """
+    path = manifest_path()
+    exists = os.path.exists(path)
+    if not create and not exists:
+        return None
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path, timeout=30)
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS artefact (
+          path TEXT PRIMARY KEY,
+          method TEXT NOT NULL,
+          practice_id TEXT NOT NULL,
+          size INTEGER NOT NULL,
+          sha1 TEXT NOT NULL,
+          created TEXT NOT NULL
+        )
+        """
+    )
+    # Which version of each letter went into which combined PDF
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS combined (
+          path TEXT PRIMARY KEY,
+          sha1 TEXT NOT NULL,
+          output TEXT NOT NULL,
+          created TEXT NOT NULL
+        )
+        """
+    )
+    if not exists:
+        record_existing_artefacts(db)
+    return db
+
+
+def record_existing_artefacts(db):
+    """Record the messages already in DATA_DIR
+    """
+    for dirname, (method, filename) in MESSAGE_FILES.items():
+        pattern = os.path.join(glob.escape(settings.DATA_DIR), dirname, "*", filename)
+        for path in sorted(glob.glob(pattern)):
+            practice_id = os.path.basename(os.path.dirname(path))
+            insert_artefact(db, method, practice_id, path)
+
+
+def file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(65536), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def record_artefact(db, intervention, path):
+    """Record the message at `path` as generated for `intervention`,
+    replacing any previous record of it.
+
+    Paths are stored relative to DATA_DIR, so the data can be moved.
+    """
+    insert_artefact(db, intervention.method, intervention.practice_id, path)
+
+
+def insert_artefact(db, method, practice_id, path):
+    with db:
+        db.execute(
+            "INSERT OR REPLACE INTO artefact VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                os.path.relpath(path, settings.DATA_DIR),
+                method,
+                practice_id,
+                os.path.getsize(path),
+                file_sha1(path),
+                datetime.utcnow().isoformat(),
+            ),
+        )
+
+
+def artefact_paths(db, method=None, practice_id=None):
+    """Return the absolute paths of the recorded messages, optionally for
+    only one method and/or practice, in order
+    """
+    sql = "SELECT path FROM artefact WHERE 1 = 1"
+    params = []
+    if method:
+        sql += " AND method = ?"
+        params.append(method)
+    if practice_id:
+        sql += " AND practice_id = ?"
+        params.append(practice_id)
+    sql += " ORDER BY path"
+    return [os.path.join(settings.DATA_DIR, path) for path, in db.execute(sql, params)]
+
+
+def uncombined_artefacts(db, method="p"):
+    """Return `(path, practice_id)` for each recorded message not yet in a
+    combined PDF, or changed since it was, in order of path
+    """
+    rows = db.execute(
+        """
+        SELECT a.path, a.practice_id
+        FROM artefact a
+        LEFT JOIN combined c ON c.path = a.path AND c.sha1 = a.sha1
+        WHERE a.method = ? AND c.path IS NULL
+        ORDER BY a.path
+        """,
+        [method],
+    )
+    return [
+        (os.path.join(settings.DATA_DIR, path), practice_id)
+        for path, practice_id in rows
+    ]
+
+
+def record_combined(db, paths, output):
+    """Record that the messages at `paths`, as they are now, have been
+    combined into `output`
+    """
+    created = datetime.utcnow().isoformat()
+    with db:
+        db.executemany(
+            """
+            INSERT OR REPLACE INTO combined
+            SELECT path, sha1, ?, ? FROM artefact WHERE path = ?
+            """,
+            [
+                (
+                    os.path.relpath(output, settings.DATA_DIR),
+                    created,
+                    os.path.relpath(path, settings.DATA_DIR),
+                )
+                for path in paths
+            ],
+        )
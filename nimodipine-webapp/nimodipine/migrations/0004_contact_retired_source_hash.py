@@ -0,0 +1,21 @@
+# Generated by Django 2.2.13 on 2026-10-18 10:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("nimodipine", "0003_maillog")]
+
+    operations = [
+        migrations.AddField(
+            model_name="interventioncontact",
+            name="retired",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="interventioncontact",
+            name="source_hash",
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+    ]
@@ -0,0 +1,16 @@
+# Generated by Django 2.2.13 on 2026-10-18 11:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("nimodipine", "0004_contact_retired_source_hash")]
+
+    operations = [
+        migrations.AddField(
+            model_name="intervention",
+            name="fax_id",
+            field=models.CharField(blank=True, max_length=32, null=True),
+        )
+    ]
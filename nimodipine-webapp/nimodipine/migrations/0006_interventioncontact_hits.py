@@ -0,0 +1,33 @@
+# Generated by Django 2.2.13 on 2026-10-18 14:20
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum
+
+
+def count_contact_hits(apps, schema_editor):
+    Intervention = apps.get_model("nimodipine", "Intervention")
+    InterventionContact = apps.get_model("nimodipine", "InterventionContact")
+    totals = (
+        Intervention.objects.filter(contact=OuterRef("pk"))
+        .order_by()
+        .values("contact")
+        .annotate(total=Sum("hits"))
+        .values("total")
+    )
+    InterventionContact.objects.filter(intervention__hits__gt=0).update(
+        hits=Subquery(totals)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("nimodipine", "0005_intervention_fax_id")]
+
+    operations = [
+        migrations.AddField(
+            model_name="interventioncontact",
+            name="hits",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_contact_hits, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 2.2.13 on 2026-10-18 15:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("nimodipine", "0006_interventioncontact_hits")]
+
+    operations = [
+        migrations.CreateModel(
+            name="ClickEvent",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("timestamp", models.DateTimeField(db_index=True)),
+                ("user_agent", models.TextField(blank=True)),
+                (
+                    "intervention",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="nimodipine.Intervention",
+                    ),
+                ),
+            ],
+        )
+    ]
@@ -0,0 +1,16 @@
+# Generated by Django 2.2.13 on 2026-10-18 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("nimodipine", "0007_clickevent")]
+
+    operations = [
+        migrations.AlterField(
+            model_name="interventioncontact",
+            name="normalised_fax",
+            field=models.CharField(blank=True, db_index=True, max_length=25, null=True),
+        )
+    ]
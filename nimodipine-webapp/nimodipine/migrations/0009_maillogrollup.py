@@ -0,0 +1,29 @@
+# Generated by Django 2.2.13 on 2026-10-18 16:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("nimodipine", "0008_contact_normalised_fax_index")]
+
+    operations = [
+        migrations.CreateModel(
+            name="MailLogRollup",
+            fields=[
+                (
+                    "recipient",
+                    models.CharField(max_length=254, primary_key=True, serialize=False),
+                ),
+                ("delivered", models.BooleanField(default=False)),
+                ("opened", models.BooleanField(default=False)),
+                ("clicked", models.BooleanField(default=False)),
+                ("bounced", models.BooleanField(default=False)),
+                ("first_delivered", models.DateTimeField(blank=True, null=True)),
+                ("first_opened", models.DateTimeField(blank=True, null=True)),
+                ("first_clicked", models.DateTimeField(blank=True, null=True)),
+                ("first_bounced", models.DateTimeField(blank=True, null=True)),
+                ("last_event", models.DateTimeField(blank=True, null=True)),
+            ],
+        )
+    ]
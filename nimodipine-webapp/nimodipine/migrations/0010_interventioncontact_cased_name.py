@@ -0,0 +1,60 @@
+# Generated by Django 2.2.13 on 2026-10-18 17:05
+
+import re
+
+from django.db import migrations, models
+
+from titlecase import titlecase
+
+# A copy of the casing in `common.utils.nhs_titlecase` as it was when this
+# migration was written, so that later changes to it don't change what
+# this migration does
+TWO_LETTER_WORDS = ["at", "of", "in", "on", "to", "is", "me", "by", "dr", "st"]
+TITLE_WORDS = ["dr", "st"]
+ACRONYMS = ["NHS", "CCG", "PMS", "SMA", "PWSI", "OOH", "HIV"]
+VOWELLESS_WORDS = ["ptnrs", "by", "ccgs"]
+
+
+def word_case(word, **kwargs):
+    lower = word.lower()
+    if len(word) == 2 and lower not in TWO_LETTER_WORDS:
+        return word.upper()
+    elif lower in TITLE_WORDS:
+        return word.title()
+    elif word.upper() in ACRONYMS:
+        return word.upper()
+    elif "&" in word:
+        return word.upper()
+    elif lower not in VOWELLESS_WORDS and not re.search(r"[aeiou]", lower):
+        return word.upper()
+
+
+def case_name(name):
+    if name:
+        name = re.sub(r"Dr ([a-z]{2})", "Dr \1", titlecase(name, callback=word_case))
+    return name
+
+
+def case_names(apps, schema_editor):
+    InterventionContact = apps.get_model("nimodipine", "InterventionContact")
+    contacts = list(InterventionContact.objects.only("name"))
+    cased = {}
+    for contact in contacts:
+        if contact.name not in cased:
+            cased[contact.name] = case_name(contact.name)
+        contact.cased_name = cased[contact.name]
+    InterventionContact.objects.bulk_update(contacts, ["cased_name"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("nimodipine", "0009_maillogrollup")]
+
+    operations = [
+        migrations.AddField(
+            model_name="interventioncontact",
+            name="cased_name",
+            field=models.CharField(blank=True, default="", max_length=200),
+        ),
+        migrations.RunPython(case_names, migrations.RunPython.noop),
+    ]
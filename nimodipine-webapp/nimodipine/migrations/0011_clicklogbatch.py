@@ -0,0 +1,21 @@
+# Generated by Django 2.2.13 on 2026-10-18 18:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("nimodipine", "0010_interventioncontact_cased_name")]
+
+    operations = [
+        migrations.CreateModel(
+            name="ClickLogBatch",
+            fields=[
+                (
+                    "name",
+                    models.CharField(max_length=255, primary_key=True, serialize=False),
+                ),
+                ("applied", models.DateTimeField(auto_now_add=True)),
+            ],
+        )
+    ]
@@ -1,24 +1,28 @@
 from datetime import date
+from datetime import timedelta
 import csv
 import os
-import re
 
 from django.conf import settings
 from django.contrib.postgres.fields import ArrayField
 from django.contrib.postgres.fields import JSONField
+from django.db import connection
 from django.db import models
-from django.db.models import Sum
+from django.db.models import Max
 from django.urls import reverse
 
 from anymail.signals import EventType
 
 from common.utils import nhs_titlecase
+from common.utils import normalise_fax
 from common.utils import not_empty
 
 
 class InterventionContact(models.Model):
     practice_id = models.CharField(max_length=6, primary_key=True)
     name = models.CharField(max_length=200)
+    # `name` as it appears in messages, set whenever `name` is
+    cased_name = models.CharField(max_length=200, blank=True, default="")
     address1 = models.CharField(max_length=100, null=True, blank=True)
     address2 = models.CharField(max_length=100, null=True, blank=True)
     address3 = models.CharField(max_length=100, null=True, blank=True)
@@ -26,35 +30,116 @@ class InterventionContact(models.Model):
     postcode = models.CharField(max_length=9, null=True, blank=True)
     email = models.EmailField(max_length=200, null=True, blank=True)
     fax = models.CharField(max_length=25, null=True, blank=True)
-    normalised_fax = models.CharField(max_length=25, null=True, blank=True)
+    normalised_fax = models.CharField(
+        max_length=25, null=True, blank=True, db_index=True
+    )
     blacklisted = models.BooleanField(default=False)
+    # Set when a practice is no longer in the contacts spreadsheet
+    retired = models.BooleanField(default=False)
+    # Hash of the spreadsheet row this contact was loaded from
+    source_hash = models.CharField(max_length=40, null=True, blank=True)
     # "Did the message we sent give you new information about prescribing?"
     survey_response = models.NullBooleanField(default=None)
+    # Total hits across all this contact's interventions, kept up to date
+    # by `record_hit()`
+    hits = models.IntegerField(default=0)
 
     def __str__(self):
         return "{} ({})".format(self.name, self.practice_id)
 
-    @property
-    def cased_name(self):
-        return nhs_titlecase(self.name)
-
     def total_hits(self):
-        return self.intervention_set.aggregate(Sum("hits"))["hits__sum"]
+        return self.hits
 
     def save(self, *args, **kwargs):
-        fax_number = re.sub(r"[^0-9]", "", self.fax)
-        if fax_number and re.search(r"[0-9]{8}", fax_number):
-            if fax_number[:2] != "00":
-                if fax_number[0] == "0":
-                    fax_number = fax_number[1:]
-                if fax_number[:2] == "44":
-                    fax_number = "00" + fax_number
-                else:
-                    fax_number = "0044" + fax_number
-        self.normalised_fax = fax_number
+        self.normalised_fax = normalise_fax(self.fax)
+        self.cased_name = nhs_titlecase(self.name)
         super(InterventionContact, self).save(*args, **kwargs)
 
 
+def target_url(method, practice_id):
+    # add Google Analytics tracking
+    querystring = "utm_source=nimodipine&utm_medium={}".format(
+        dict(Intervention.METHOD_CHOICES)[method].lower()
+    )
+    return "{}/measure/nimodipine/practice/{}/?{}".format(
+        settings.OP_HOST, practice_id, querystring
+    )
+
+
+def record_hit(method, practice_id, user_agent=""):
+    """Count a click on an intervention's URL against both the
+    intervention and its contact, and log it as a ClickEvent, in a
+    single statement.
+
+    Returns the contact's new total number of hits, or None if there is
+    no such intervention.
+    """
+    sql = """
+      WITH intervention AS (
+        UPDATE {intervention} SET hits = hits + 1
+        WHERE method = %s AND practice_id = %s
+        RETURNING id, contact_id
+      ), click AS (
+        INSERT INTO {click} (intervention_id, timestamp, user_agent)
+        SELECT id, now(), %s FROM intervention
+      )
+      UPDATE {contact} SET hits = {contact}.hits + 1
+      FROM intervention
+      WHERE {contact}.practice_id = intervention.contact_id
+      RETURNING {contact}.hits
+    """.format(
+        intervention=Intervention._meta.db_table,
+        contact=InterventionContact._meta.db_table,
+        click=ClickEvent._meta.db_table,
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [method, practice_id, user_agent])
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def fax_status_receipt(status):
+    """Map an InterFAX status code to a receipt: True when delivered,
+    False when failed, or None for a temporary status. Raises ValueError
+    if the status isn't a number.
+
+    See https://www.interfax.net/en/help/error_codes
+    """
+    if int(status) == 0:
+        return True
+    elif int(status) > 0:
+        return False
+    return None
+
+
+def set_fax_receipts(normalised_faxes, receipt):
+    """Set the receipt of every fax intervention sent to any of the given
+    (normalised) fax numbers, in a single statement.
+
+    Returns the IDs of the interventions updated.
+    """
+    sql = """
+      UPDATE {intervention} SET receipt = %s
+      FROM {contact}
+      WHERE {intervention}.contact_id = {contact}.practice_id
+        AND {intervention}.method = 'f'
+        AND {contact}.normalised_fax = ANY(%s)
+      RETURNING {intervention}.id
+    """.format(
+        intervention=Intervention._meta.db_table,
+        contact=InterventionContact._meta.db_table,
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [receipt, list(normalised_faxes)])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def is_contactable(method, email):
+    if method == "p":
+        return True
+    return not_empty(email)
+
+
 class Intervention(models.Model):
     METHOD_CHOICES = (("e", "Email"), ("p", "Post"), ("f", "Fax"))
     created_date = models.DateField(default=date.today)
@@ -65,6 +150,8 @@ class Intervention(models.Model):
     sent = models.BooleanField(default=False)
     generated = models.BooleanField(default=False)
     receipt = models.NullBooleanField(default=None)
+    # The ID InterFAX gave a sent fax, for reconciling its delivery status
+    fax_id = models.CharField(max_length=32, null=True, blank=True)
     contact = models.ForeignKey(InterventionContact, on_delete=models.CASCADE)
 
     class Meta:
@@ -87,51 +174,48 @@ class Intervention(models.Model):
         )
 
     def contactable(self):
-        if self.method == "p":
-            return True
-        return not_empty(self.contact.email)
+        return is_contactable(self.method, self.contact.email)
 
     def get_absolute_url(self):
         return reverse("views.intervention", args=[self.method, self.practice_id])
 
     def get_target_url(self):
-        # add Google Analytics tracking
-        querystring = "utm_source=nimodipine&utm_medium={}".format(
-            self.get_method_display().lower()
-        )
-        target_url = "{}/measure/nimodipine/practice/{}/?{}".format(
-            settings.OP_HOST, self.practice_id, querystring
-        )
-        return target_url
+        return target_url(self.method, self.practice_id)
 
     def mail_logs(self):
         return MailLog.objects.filter(
             tags__contained_by=["nimodipine"], recipient__iexact=self.contact.email
         )
 
+    def mail_rollup(self):
+        """Return the MailLogRollup for this intervention's email address,
+        if there is one
+        """
+        if self.contact.email:
+            return MailLogRollup.objects.filter(
+                recipient=self.contact.email.lower()
+            ).first()
+
     def set_receipt(self):
         if self.method == "e":
-            found = self.mail_logs()
+            found = self.mail_rollup()
             if found:
-                if found.filter(event_type="delivered"):
+                if found.delivered:
                     self.receipt = True
-                elif found.filter(event_type__in=["bounced", "rejected"]):
+                elif found.bounced:
                     self.receipt = False
                 self.save()
 
     def get_opened(self):
         if self.method == "e":
-            found = self.mail_logs()
-            if found:
-                if found.filter(event_type="opened"):
-                    print("{},{}".format(self.practice_id))
+            found = self.mail_rollup()
+            if found and found.opened:
+                print("{},{}".format(self.practice_id, found.first_opened))
 
     def message_dir(self):
-        location = os.path.join(
+        return os.path.join(
             settings.DATA_DIR, self.get_method_display().lower(), self.practice_id
         )
-        os.makedirs(location, exist_ok=True)
-        return location
 
     def message_path(self):
         if self.method == "p":
@@ -142,17 +226,47 @@ class Intervention(models.Model):
             filename = "email.html"
         return os.path.join(self.message_dir(), filename)
 
-    def is_generated(self):
+    def is_generated(self, generated_paths=None):
+        """Has this intervention's message been generated?
+
+        `generated_paths` is an optional set of the paths recorded in the
+        manifest, which saves checking the filesystem for those.
+        """
         if self.generated:
-            if os.path.exists(self.message_path()):
+            path = self.message_path()
+            if generated_paths is not None and path in generated_paths:
+                return True
+            if os.path.exists(path):
                 return True
             else:
                 raise Exception(
                     "Intervention {} supposedly generated "
-                    "but no file at {}".format(self, self.message_path())
+                    "but no file at {}".format(self, path)
                 )
 
 
+class ClickEvent(models.Model):
+    """A single click on an intervention's tracked URL"""
+
+    intervention = models.ForeignKey(Intervention, on_delete=models.CASCADE)
+    timestamp = models.DateTimeField(db_index=True)
+    user_agent = models.TextField(blank=True)
+
+    def __str__(self):
+        return "{}: {}".format(self.timestamp, self.intervention)
+
+
+class ClickLogBatch(models.Model):
+    """A moved-aside click log whose clicks have been applied, recorded in
+    the same transaction so that they are never applied twice"""
+
+    name = models.CharField(max_length=255, primary_key=True)
+    applied = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
+
+
 # Copied from openprescribing, where this model is created via mailgun
 # callbacks
 class MailLog(models.Model):
@@ -177,3 +291,116 @@ class MailLog(models.Model):
 
     def __str__(self):
         return "{}: <{}> {}".format(self.timestampe, self.recipient, self.event_type)
+
+
+class MailLogRollup(models.Model):
+    """What we know about the nimodipine emails to each recipient,
+    summarised from the (very large, shared) MailLog table by
+    `refresh_mail_rollup()`
+    """
+
+    # Lowercased
+    recipient = models.CharField(max_length=254, primary_key=True)
+    delivered = models.BooleanField(default=False)
+    opened = models.BooleanField(default=False)
+    clicked = models.BooleanField(default=False)
+    bounced = models.BooleanField(default=False)
+    first_delivered = models.DateTimeField(null=True, blank=True)
+    first_opened = models.DateTimeField(null=True, blank=True)
+    first_clicked = models.DateTimeField(null=True, blank=True)
+    first_bounced = models.DateTimeField(null=True, blank=True)
+    # The latest MailLog timestamp seen for this recipient; the latest
+    # across all recipients is where the next refresh starts from
+    last_event = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.recipient
+
+
+# How far before the high-water mark to start each refresh, to pick up
+# events logged late. Refreshing is idempotent, so overlap is harmless.
+MAIL_ROLLUP_OVERLAP = timedelta(hours=1)
+
+
+def refresh_mail_rollup(full=False):
+    """Bring MailLogRollup up to date with nimodipine-tagged MailLog events
+    since the last refresh (or all of them, if `full`).
+
+    Returns the number of recipients added or updated.
+    """
+    since = None
+    if not full:
+        since = MailLogRollup.objects.aggregate(Max("last_event"))["last_event__max"]
+    params = []
+    where = "tags <@ ARRAY['nimodipine']::varchar[]"
+    if since is not None:
+        # Events without a timestamp can't be placed, so are always included
+        where += " AND (timestamp IS NULL OR timestamp > %s)"
+        params.append(since - MAIL_ROLLUP_OVERLAP)
+    sql = """
+      INSERT INTO {rollup} AS r (
+        recipient, delivered, opened, clicked, bounced,
+        first_delivered, first_opened, first_clicked, first_bounced,
+        last_event
+      )
+      SELECT
+        LOWER(recipient),
+        bool_or(event_type = 'delivered'),
+        bool_or(event_type = 'opened'),
+        bool_or(event_type = 'clicked'),
+        bool_or(event_type IN ('bounced', 'rejected')),
+        MIN(timestamp) FILTER (WHERE event_type = 'delivered'),
+        MIN(timestamp) FILTER (WHERE event_type = 'opened'),
+        MIN(timestamp) FILTER (WHERE event_type = 'clicked'),
+        MIN(timestamp) FILTER (WHERE event_type IN ('bounced', 'rejected')),
+        MAX(timestamp)
+      FROM {maillog}
+      WHERE {where}
+      GROUP BY LOWER(recipient)
+      ON CONFLICT (recipient) DO UPDATE SET
+        delivered = r.delivered OR EXCLUDED.delivered,
+        opened = r.opened OR EXCLUDED.opened,
+        clicked = r.clicked OR EXCLUDED.clicked,
+        bounced = r.bounced OR EXCLUDED.bounced,
+        first_delivered = LEAST(r.first_delivered, EXCLUDED.first_delivered),
+        first_opened = LEAST(r.first_opened, EXCLUDED.first_opened),
+        first_clicked = LEAST(r.first_clicked, EXCLUDED.first_clicked),
+        first_bounced = LEAST(r.first_bounced, EXCLUDED.first_bounced),
+        last_event = GREATEST(r.last_event, EXCLUDED.last_event)
+    """.format(
+        rollup=MailLogRollup._meta.db_table,
+        maillog=MailLog._meta.db_table,
+        where=where,
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+
+def reconcile_email_receipts():
+    """Set the receipt status of every sent email without one, from the
+    mailgun logs (as of the last `refresh_mail_rollup()`).
+
+    This is the set-based equivalent of calling `set_receipt()` on each
+    intervention, in a single UPDATE.
+
+    Returns the number of interventions updated.
+    """
+    sql = """
+      UPDATE {intervention} AS i
+      SET receipt = r.delivered
+      FROM {contact} AS c, {rollup} AS r
+      WHERE i.contact_id = c.practice_id
+        AND LOWER(c.email) = r.recipient
+        AND i.method = 'e'
+        AND i.sent
+        AND i.receipt IS NULL
+        AND (r.delivered OR r.bounced)
+    """.format(
+        intervention=Intervention._meta.db_table,
+        contact=InterventionContact._meta.db_table,
+        rollup=MailLogRollup._meta.db_table,
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql)
+        return cursor.rowcount
@@ -0,0 +1,366 @@
+import base64
+from io import BytesIO
+import functools
+import html
+import logging
+import os
+import re
+
+from PIL import Image
+from PIL import ImageDraw
+from PIL import ImageFont
+
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.safestring import SafeText
+from premailer import Premailer
+
+logger = logging.getLogger(__name__)
+
+
+def intervention_context(intervention, encoded_image=None):
+    """Build the context for rendering `intervention.html` for an
+    intervention, optionally with a chart that has already been drawn
+    """
+    practice_name = intervention.contact.cased_name
+    context = {}
+    show_header_from = True
+    if intervention.method == "p":
+        show_header_to = True
+    else:
+        show_header_to = False
+    if encoded_image is None:
+        encoded_image = make_chart(intervention.metadata["value"])
+    header_image = static_image("header.png")
+    footer_image = static_image("footer.png")
+    intervention_url = "op2.org.uk{}".format(intervention.get_absolute_url())
+    intervention_url = '<a href="http://{}">{}</a>'.format(
+        intervention_url, intervention_url
+    )
+    context.update(
+        {
+            "intervention": intervention,
+            "practice_name": practice_name,
+            "intervention_url": SafeText(intervention_url),
+            "encoded_image": encoded_image,
+            "header_image": header_image,
+            "footer_image": footer_image,
+            "show_header_from": show_header_from,
+            "show_header_to": show_header_to,
+        }
+    )
+    return context
+
+
+def render_intervention_message(intervention, encoded_image=None):
+    """Render the HTML message for an intervention, without needing a
+    request (or a running web server)
+    """
+    return render_to_string(
+        "intervention.html", intervention_context(intervention, encoded_image)
+    )
+
+
+# Stand-ins for the parts of an email which vary between interventions,
+# chosen to pass through CSS inlining untouched
+EMAIL_PLACEHOLDERS = {
+    "practice_id": "ZZPRACTICEIDZZ",
+    "practice_name": "ZZPRACTICENAMEZZ",
+    "encoded_image": "ZZENCODEDIMAGEZZ",
+}
+EMAIL_PLACEHOLDERS_RE = re.compile(
+    "|".join(re.escape(x) for x in EMAIL_PLACEHOLDERS.values())
+)
+
+
+def inline_css(html):
+    return Premailer(html, cssutils_logging_level=logging.ERROR).transform()
+
+
+def render_email_message(intervention, encoded_image=None, template_version=None):
+    """Render the email for an intervention, with its CSS inlined.
+
+    Rather than running Premailer on every email, the CSS is inlined once
+    into the template (see `compiled_email_template()`), and each
+    intervention's details are substituted into that.  When rendering
+    many emails, pass the `email_template_version()` to save finding it
+    for each one.
+    """
+    if encoded_image is None:
+        encoded_image = make_chart(intervention.metadata["value"])
+    if template_version is None:
+        template_version = email_template_version()
+    compiled = compiled_email_template(template_version)
+    if compiled is None:
+        return inline_css(render_intervention_message(intervention, encoded_image))
+    replacements = {
+        EMAIL_PLACEHOLDERS["practice_id"]: intervention.practice_id,
+        # Escaped as Premailer's serialiser escapes text
+        EMAIL_PLACEHOLDERS["practice_name"]: html.escape(
+            intervention.contact.cased_name, quote=False
+        ),
+        EMAIL_PLACEHOLDERS["encoded_image"]: encoded_image,
+    }
+    return EMAIL_PLACEHOLDERS_RE.sub(lambda m: replacements[m.group(0)], compiled)
+
+
+def email_template_version():
+    """Return something which changes whenever every email would: when a
+    template or static image changes, or the date (in the letterhead)
+    """
+    template_dir = os.path.join(settings.BASE_DIR, "nimodipine", "templates")
+    static_dir = os.path.join(settings.BASE_DIR, "nimodipine", "static")
+    paths = [
+        os.path.join(template_dir, name) for name in sorted(os.listdir(template_dir))
+    ]
+    paths += [os.path.join(static_dir, name) for name in STATIC_IMAGES]
+    return tuple(os.stat(path).st_mtime for path in paths) + (timezone.localdate(),)
+
+
+@functools.lru_cache(maxsize=4)
+def compiled_email_template(version):
+    """Render the email template with placeholders, and inline its CSS.
+
+    Returns None if any placeholder didn't survive, in which case each
+    email must be inlined separately.
+    """
+    from nimodipine.models import Intervention
+    from nimodipine.models import InterventionContact
+
+    practice_id = EMAIL_PLACEHOLDERS["practice_id"]
+    placeholder = Intervention(
+        method="e",
+        practice_id=practice_id,
+        contact=InterventionContact(practice_id=practice_id, name=""),
+    )
+    context = intervention_context(placeholder, EMAIL_PLACEHOLDERS["encoded_image"])
+    context["practice_name"] = EMAIL_PLACEHOLDERS["practice_name"]
+    compiled = inline_css(render_to_string("intervention.html", context))
+    missing = [x for x in EMAIL_PLACEHOLDERS.values() if x not in compiled]
+    if missing:
+        logger.warning(
+            "Placeholders %s lost inlining CSS; inlining each email", missing
+        )
+        return None
+    return compiled
+
+
+# Images from `nimodipine/static` which appear in every message
+STATIC_IMAGES = ("header.png", "footer.png")
+
+# Base64-encoded static images, keyed by path, as (mtime, encoded)
+# tuples
+_static_images = {}
+
+
+def static_image(filename):
+    """Return the base64-encoding of an image in `nimodipine/static`.
+
+    Each image is read and encoded once per process, and again only if
+    its mtime changes.
+    """
+    path = os.path.join(settings.BASE_DIR, "nimodipine", "static", filename)
+    mtime = os.stat(path).st_mtime
+    cached = _static_images.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, "rb") as img:
+        encoded = base64.b64encode(img.read()).decode("ascii")
+    _static_images[path] = (mtime, encoded)
+    return encoded
+
+
+def static_image_filename(encoded):
+    """Return the filename of the static image in `STATIC_IMAGES` with
+    this base64-encoding, or None
+    """
+    for filename in STATIC_IMAGES:
+        if static_image(filename) == encoded:
+            return filename
+    return None
+
+
+# Chart dimensions
+X_AXIS_ORIGIN_COORDS = (69, 221)
+X_AXIS_END_COORDS = (388, 221)
+X_AXIS_WIDTH = X_AXIS_END_COORDS[0] - X_AXIS_ORIGIN_COORDS[0]
+X_AXIS_MAX = 240  # The value at the extreme end of X-axis
+BLUE_LINE_COORDS = (77, 17)  # coords of pointer to the peak in the chart
+
+
+def chart_geometry(practice_value):
+    """Return the two things a chart depends on: the (rounded) value in
+    the label, and the x position of the arrow pointing at it
+    """
+    practice_x = X_AXIS_ORIGIN_COORDS[0] + int(
+        (float(practice_value) / X_AXIS_MAX * X_AXIS_WIDTH)
+    )
+    return round(float(practice_value)), practice_x
+
+
+def make_chart(practice_value):
+    """Draw lines on a pre-made chart pointing to a peak (always in the
+    same place), and a point on the axis (variable).
+
+    Charts are cached in memory and, if `settings.CHART_CACHE_DIR` is
+    set, on disk, so each distinct chart is only drawn once.
+
+    Args:
+       practice_value: numeric value that will be plotted on x-axis
+
+    Returns:
+       base64-encoded image
+
+    """
+    return _cached_chart(*chart_geometry(practice_value))
+
+
+@functools.lru_cache(maxsize=settings.CHART_CACHE_SIZE)
+def _cached_chart(label_value, practice_x):
+    cache_path = None
+    if settings.CHART_CACHE_DIR:
+        cache_path = os.path.join(
+            settings.CHART_CACHE_DIR, "chart-{}-{}.png".format(label_value, practice_x)
+        )
+        if os.path.exists(cache_path):
+            with open(cache_path, "rb") as f:
+                return base64.b64encode(f.read()).decode("ascii")
+    png = draw_chart(label_value, practice_x)
+    if cache_path:
+        write_atomically(cache_path, png)
+    return base64.b64encode(png).decode("ascii")
+
+
+def make_charts(practice_values):
+    """Draw the charts for a whole wave at once.
+
+    Every distinct chart is drawn only once, and shares the cache used
+    by `make_chart`.  Interventions whose values can't be charted are
+    logged and left out.
+
+    Args:
+       practice_values: iterable of (intervention_id, practice_value)
+
+    Returns:
+       dict of intervention_id -> base64-encoded image
+
+    """
+    geometries = {}
+    for intervention_id, value in practice_values:
+        try:
+            geometries[intervention_id] = chart_geometry(value)
+        except (TypeError, ValueError):
+            logger.warning(
+                "Can't chart value %r for intervention %s", value, intervention_id
+            )
+    encoded_charts = {
+        geometry: _cached_chart(*geometry) for geometry in set(geometries.values())
+    }
+    return {
+        intervention_id: encoded_charts[geometry]
+        for intervention_id, geometry in geometries.items()
+    }
+
+
+def write_atomically(path, data):
+    """Write then rename, so concurrent readers never see half a file
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+@functools.lru_cache(maxsize=1)
+def _base_chart():
+    base_image_path = os.path.join(
+        settings.BASE_DIR, "nimodipine", "static", "chart.png"
+    )
+    im = Image.open(base_image_path)
+    im.load()
+    return im
+
+
+@functools.lru_cache(maxsize=1)
+def _chart_font():
+    try:
+        return ImageFont.truetype("arial.ttf", 14)
+    except OSError:  # font not installed
+        try:
+            # Use Free version of Arial
+            return ImageFont.truetype("LiberationSans-Regular.ttf", 14)
+        except OSError:
+            # fallback to anything
+            logger.warn("Falling back to default font for drawing charts")
+            return ImageFont.load_default()
+
+
+def draw_chart(label_value, practice_x):
+    """Draw a chart (see `make_chart`) for the geometry returned by
+    `chart_geometry`
+
+    Returns:
+       PNG-encoded image
+
+    """
+    im = _base_chart().copy()
+    d = ImageDraw.Draw(im)
+    fnt = _chart_font()
+
+    blue_text = "99% of practices \n(0 tablets per 1000 patients)"
+    red_text = "Your practice\n({} tablets per 1000 patients)".format(label_value)
+    practice_coords = (practice_x, X_AXIS_ORIGIN_COORDS[1])
+    # Arrived at by trial-and-error, so red text never overflows right edge of chart:
+    red_text_max_x = 180
+    red_text_min_x = BLUE_LINE_COORDS[0] + 2
+
+    # Draw line pointing at peak
+    blue_line_feather_end_coords = (BLUE_LINE_COORDS[0] + 60, BLUE_LINE_COORDS[1])
+    blue_text_coords = (
+        blue_line_feather_end_coords[0] + 5,
+        blue_line_feather_end_coords[1] - 6,
+    )
+    arrow(d, BLUE_LINE_COORDS, blue_line_feather_end_coords, fill="blue")
+    d.text(blue_text_coords, blue_text, font=fnt, fill="blue")
+
+    # Draw line pointing at practice
+    red_line_feather_end_coords = (practice_coords[0], practice_coords[1] - 25)
+    red_text_x = red_line_feather_end_coords[0] - 20
+    if red_text_x < red_text_min_x:
+        red_text_x = red_text_min_x
+    elif red_text_x > red_text_max_x:
+        red_text_x = red_text_max_x
+    red_text_coords = (red_text_x, red_line_feather_end_coords[1] - 40)
+    arrow(d, practice_coords, red_line_feather_end_coords)
+    d.text(red_text_coords, red_text, font=fnt, fill="red")
+
+    mock_file = BytesIO()
+    im.save(mock_file, "png")
+    return mock_file.getvalue()
+
+
+def arrow(d, arrow_end, feather_end, fill="red", width=1):
+    if arrow_end[0] == feather_end[0]:
+        orientation = "vertical"
+    elif arrow_end[1] == feather_end[1]:
+        orientation = "horizontal"
+    else:
+        raise BaseException("Must be horizontal or vertical")
+
+    d.line((arrow_end, feather_end), fill=fill, width=width)
+    if orientation == "vertical":
+        d.line(
+            (arrow_end, (arrow_end[0] - 5, arrow_end[1] - 5)), fill=fill, width=width
+        )
+        d.line(
+            (arrow_end, (arrow_end[0] + 5, arrow_end[1] - 5)), fill=fill, width=width
+        )
+    else:
+        d.line(
+            (arrow_end, (arrow_end[0] + 5, arrow_end[1] - 5)), fill=fill, width=width
+        )
+        d.line(
+            (arrow_end, (arrow_end[0] + 5, arrow_end[1] + 5)), fill=fill, width=width
+        )
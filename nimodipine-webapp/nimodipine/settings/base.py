@@ -149,6 +149,50 @@ GRAB_CMD = "/usr/local/bin/phantomjs " + BASE_DIR + "/scripts/grab_chart.js"
 PRINT_CMD = "/usr/local/bin/phantomjs " + BASE_DIR + "/scripts/print_letter.js"
 DATA_DIR = BASE_DIR + "/data/"
 
+# Long-lived PhantomJS renderers (see `manage.py run_renderers`). When
+# RENDERER_URLS is empty, or a renderer isn't running, we fall back to
+# running GRAB_CMD or PRINT_CMD for each document.
+RENDER_SERVER_CMD = "/usr/local/bin/phantomjs " + BASE_DIR + "/scripts/render_server.js"
+RENDERER_URLS = [
+    url for url in utils.get_env_setting("RENDERER_URLS", "").split(",") if url
+]
+RENDERER_TIMEOUT = 120
+
+# Charts are memoised per process, up to this many distinct charts; set
+# CHART_CACHE_DIR to also keep them on disk between runs
+CHART_CACHE_SIZE = 1024
+CHART_CACHE_DIR = None
+
+# If set, tracked link clicks are appended to this file rather than
+# written to the database as they happen, and applied in batches by
+# `manage.py flush_clicks`
+CLICK_LOG_PATH = utils.get_env_setting("CLICK_LOG_PATH", "") or None
+
+# The "redirects" cache holds what a buffered click needs to know about
+# its intervention (see `nimodipine.clicks.click_target`), so repeat
+# clicks don't touch the database at all. Whether a contact has visited
+# is only recorded there until the clicks are flushed, so when clicks are
+# buffered it must be shared between gunicorn workers: it is kept on disk
+# next to the click log.
+if CLICK_LOG_PATH:
+    REDIRECTS_CACHE = {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": CLICK_LOG_PATH + ".cache",
+    }
+else:
+    REDIRECTS_CACHE = {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "redirects",
+    }
+# Culling would forget who has visited, so there's room for all of a
+# wave: a target for each of a contact's (up to 3) interventions, and
+# whether they've visited, for each of about 8,000 practices, with room
+# to spare.
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "redirects": dict(REDIRECTS_CACHE, TIMEOUT=3600, OPTIONS={"MAX_ENTRIES": 50000}),
+}
+
 # Mail settings
 
 ANYMAIL = {
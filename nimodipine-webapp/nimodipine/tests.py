@@ -1,15 +1,38 @@
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
 from email.utils import unquote
+from io import StringIO
 from unittest.mock import Mock
+from unittest import skipUnless
 from unittest.mock import patch
+import base64
+import csv
+import gzip
+import hashlib
 import os
+import queue
+import shutil
+import tempfile
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
 
 from django.conf import settings
+from django.core.cache import caches
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import Client
 from django.test import TestCase
 
+from common.utils import nhs_titlecase
+from common.utils import nhs_titlecase_all
+from nimodipine.models import ClickEvent
 from nimodipine.models import Intervention
 from nimodipine.models import InterventionContact
+from nimodipine.models import refresh_mail_rollup
 
 
 class ModelTestCase(TestCase):
@@ -35,10 +58,28 @@ class ModelTestCase(TestCase):
             contact.save()
             self.assertEqual(contact.normalised_fax, expected)
 
+    def test_cased_name(self):
+        contact = InterventionContact.objects.first()
+        contact.name = "ST MARY'S NHS HC, DR SMITH"
+        contact.save()
+        self.assertEqual(
+            InterventionContact.objects.get(pk=contact.pk).cased_name,
+            "St Mary's NHS HC, Dr Smith",
+        )
+
+    def test_nhs_titlecase_all(self):
+        names = ["THE DOVECOT SURGERY", "", "OOH CENTRE", "THE DOVECOT SURGERY"]
+        self.assertEqual(
+            nhs_titlecase_all(names), [nhs_titlecase(name) for name in names]
+        )
+
 
 class ReceiptTestCase(TestCase):
     fixtures = ["intervention_contacts", "interventions", "maillogs"]
 
+    def setUp(self):
+        refresh_mail_rollup()
+
     def test_email_receipt(self):
         intervention = Intervention.objects.get(pk=1)
         self.assertEquals(intervention.receipt, None)
@@ -60,10 +101,258 @@ class ReceiptTestCase(TestCase):
         intervention.set_receipt()
         self.assertEquals(intervention.receipt, None)
 
+    def test_reconcile_email_receipts(self):
+        from nimodipine.models import reconcile_email_receipts
+
+        Intervention.objects.update(sent=True)
+        self.assertEqual(reconcile_email_receipts(), 1)
+        for intervention in Intervention.objects.all():
+            expected = intervention.receipt
+            intervention.receipt = None
+            intervention.set_receipt()
+            self.assertEqual(intervention.receipt, expected)
+        self.assertTrue(Intervention.objects.get(pk=1).receipt)
+        # Only emails without a receipt are reconciled
+        self.assertEqual(reconcile_email_receipts(), 0)
+
+    def test_reconcile_email_receipts_bounced(self):
+        from nimodipine.models import MailLog
+        from nimodipine.models import reconcile_email_receipts
+
+        MailLog.objects.create(
+            recipient="Simon.Neil2@nhs.net", tags=["nimodipine"], event_type="bounced"
+        )
+        Intervention.objects.filter(pk=5).update(sent=True)
+        # Not seen until the rollup is refreshed
+        self.assertEqual(reconcile_email_receipts(), 0)
+        refresh_mail_rollup()
+        self.assertEqual(reconcile_email_receipts(), 1)
+        self.assertIs(Intervention.objects.get(pk=5).receipt, False)
+
+    def test_refresh_mail_rollup(self):
+        from nimodipine.models import MailLog
+        from nimodipine.models import MailLogRollup
+
+        recipient = "simon.neil2@nhs.net"
+        opened = datetime(2019, 6, 3, 12, 0, tzinfo=timezone.utc)
+        for event_type, timestamp, tags in [
+            ("delivered", opened - timedelta(hours=1), ["nimodipine"]),
+            ("opened", opened, ["nimodipine"]),
+            ("clicked", opened, ["other"]),
+        ]:
+            MailLog.objects.create(
+                recipient=recipient.upper(),
+                tags=tags,
+                event_type=event_type,
+                timestamp=timestamp,
+            )
+        refresh_mail_rollup()
+        rollup = MailLogRollup.objects.get(recipient=recipient)
+        self.assertTrue(rollup.delivered)
+        self.assertFalse(rollup.clicked)
+        self.assertEqual(rollup.first_opened, opened)
+        self.assertEqual(rollup.last_event, opened)
+
+        # Only later events are read, and earlier firsts are kept
+        MailLog.objects.create(
+            recipient=recipient,
+            tags=["nimodipine"],
+            event_type="opened",
+            timestamp=opened + timedelta(days=1),
+        )
+        MailLog.objects.filter(timestamp__lte=opened).delete()
+        refresh_mail_rollup()
+        rollup = MailLogRollup.objects.get(recipient=recipient)
+        self.assertTrue(rollup.delivered)
+        self.assertEqual(rollup.first_opened, opened)
+        self.assertEqual(rollup.last_event, opened + timedelta(days=1))
+
+
+class ReportCommandTestCase(TestCase):
+    fixtures = ["intervention_contacts", "interventions", "maillogs"]
+
+    def test_generate_report(self):
+        Intervention.objects.filter(pk=1).update(sent=True)
+        InterventionContact.objects.filter(pk="A83050").update(survey_response=True)
+        with tempfile.TemporaryDirectory() as report_dir:
+            interventions = os.path.join(report_dir, "interventions.csv")
+            questionnaire = os.path.join(report_dir, "questionnaire.csv")
+            call_command(
+                "generate_report",
+                intervention_report=interventions,
+                questionnaire_report=questionnaire,
+                gzip=True,
+            )
+            with gzip.open(interventions + ".gz", "rt") as f:
+                rows = list(csv.reader(f))
+            with gzip.open(questionnaire + ".gz", "rt") as f:
+                answers = list(csv.reader(f))
+            # Both written with the same line endings
+            for path in [interventions, questionnaire]:
+                with gzip.open(path + ".gz", "rb") as f:
+                    self.assertNotIn(b"\r", f.read())
+        self.assertEqual(
+            rows[0],
+            [
+                "practice_id",
+                "method",
+                "contactable",
+                "sent",
+                "delivery_success",
+                "hits",
+            ],
+        )
+        self.assertIn(["A83050", "e", "1", "1", "1", "0"], rows)
+        self.assertIn(["A83050", "p", "1", "0", "", "1"], rows)
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(
+            answers, [["practice_id", "answer"], ["A81025", ""], ["A83050", "1"]]
+        )
+
+    def test_generate_contacts_report(self):
+        with tempfile.TemporaryDirectory() as report_dir:
+            contacts = os.path.join(report_dir, "contacts.csv")
+            call_command(
+                "generate_report",
+                intervention_report=os.path.join(report_dir, "interventions.csv"),
+                questionnaire_report=os.path.join(report_dir, "questionnaire.csv"),
+                contacts_report=contacts,
+            )
+            with open(contacts) as f:
+                rows = list(csv.DictReader(f))
+        self.assertEqual([row["practice_id"] for row in rows], ["A81025", "A83050"])
+        self.assertEqual(rows[1]["blacklisted"], "0")
+        self.assertEqual(rows[1]["hits"], "1")
+
+    @skipUnless(pyarrow, "pyarrow not installed")
+    def test_generate_report_parquet(self):
+        import pyarrow.parquet
+
+        Intervention.objects.filter(pk=1).update(sent=True)
+        with tempfile.TemporaryDirectory() as report_dir:
+            call_command(
+                "generate_report",
+                intervention_report=os.path.join(report_dir, "interventions.csv"),
+                questionnaire_report=os.path.join(report_dir, "questionnaire.csv"),
+                contacts_report=os.path.join(report_dir, "contacts.csv"),
+                maillog_report=os.path.join(report_dir, "maillog.csv"),
+                format="parquet",
+            )
+            contacts = pyarrow.parquet.read_table(
+                os.path.join(report_dir, "contacts.parquet")
+            )
+            interventions = pyarrow.parquet.read_table(
+                os.path.join(report_dir, "interventions.parquet")
+            )
+            questionnaire = pyarrow.parquet.read_table(
+                os.path.join(report_dir, "questionnaire.parquet")
+            )
+            maillog = pyarrow.parquet.read_table(
+                os.path.join(report_dir, "maillog.parquet")
+            )
+        self.assertEqual(interventions.num_rows, 5)
+        self.assertEqual(
+            interventions.schema.metadata, {b"nimodipine_report_schema": b"2"}
+        )
+        self.assertEqual(
+            contacts.to_pylist()[1],
+            {
+                "practice_id": "A83050",
+                "name": "THE DOVECOT SURGERY",
+                "address1": "THE HEALTH CENTRE",
+                "address2": "LAWSON STREET",
+                "address3": "STOCKTON ON TEES",
+                "address4": "CLEVELAND",
+                "postcode": "TS18 1HU",
+                "email": "simon.neil@nhs.net",
+                "fax": "01642 260897",
+                "normalised_fax": "00441642260897",
+                "blacklisted": False,
+                "retired": False,
+                "survey_response": None,
+                "hits": 1,
+            },
+        )
+        self.assertEqual(str(interventions.schema.field("sent").type), "bool")
+        rows = interventions.to_pylist()
+        self.assertIn(
+            {
+                "practice_id": "A83050",
+                "method": "p",
+                "contactable": True,
+                "sent": False,
+                "delivery_success": None,
+                "hits": 1,
+            },
+            rows,
+        )
+        self.assertEqual(
+            questionnaire.to_pylist(),
+            [
+                {"practice_id": "A81025", "answer": None},
+                {"practice_id": "A83050", "answer": None},
+            ],
+        )
+        self.assertIn(
+            {
+                "recipient": "simon.neil@nhs.net",
+                "delivered": True,
+                "opened": False,
+                "clicked": True,
+                "bounced": True,
+                "first_delivered": None,
+                "first_opened": None,
+                "first_clicked": None,
+                "first_bounced": None,
+            },
+            maillog.to_pylist(),
+        )
+
+
+class EngagementReportCommandTestCase(TestCase):
+    fixtures = ["intervention_contacts", "interventions", "maillogs"]
+
+    def test_generate_engagement_report(self):
+        from nimodipine.models import MailLog
+
+        opened = datetime(2019, 6, 3, 12, 0, tzinfo=timezone.utc)
+        MailLog.objects.create(
+            recipient="Simon.Neil@nhs.net",
+            tags=["nimodipine"],
+            event_type="opened",
+            timestamp=opened,
+        )
+        Intervention.objects.filter(pk=1).update(sent=True)
+        with tempfile.TemporaryDirectory() as report_dir:
+            path = os.path.join(report_dir, "engagement.csv")
+            call_command("generate_engagement_report", output=path, stdout=StringIO())
+            with open(path) as f:
+                rows = list(csv.DictReader(f))
+        self.assertEqual([row["practice_id"] for row in rows], ["A81025", "A83050"])
+        self.assertEqual(
+            rows[1],
+            {
+                "practice_id": "A83050",
+                "sent": "1",
+                "delivered": "1",
+                "opened": "1",
+                "clicked": "1",
+                "bounced": "1",
+                "first_delivered": "",
+                "first_opened": str(opened),
+                "first_clicked": "",
+                "first_bounced": "",
+            },
+        )
+        self.assertEqual(rows[0]["opened"], "0")
+
 
 class ViewTestCase(TestCase):
     fixtures = ["intervention_contacts", "interventions"]
 
+    def setUp(self):
+        caches["redirects"].clear()
+
     def test_target_url_questionnaire(self):
         client = Client()
         response = client.get("/p/A81025")  # No questionnaire hits in any wave
@@ -104,6 +393,99 @@ class ViewTestCase(TestCase):
         Client().get("/e/A83050/")
         intervention = Intervention.objects.get(pk=1)
         self.assertEqual(intervention.hits, 1)
+        self.assertEqual(intervention.contact.hits, 2)
+
+    def test_click_is_one_query(self):
+        client = Client()
+        with self.assertNumQueries(1):
+            response = client.get("/f/A83050")
+        self.assertEqual(response.status_code, 302)
+
+    def test_click_event(self):
+        Client().get("/e/A83050", HTTP_USER_AGENT="Mozilla/5.0")
+        event = ClickEvent.objects.get()
+        self.assertEqual(event.intervention_id, 1)
+        self.assertEqual(event.user_agent, "Mozilla/5.0")
+
+    def test_buffered_clicks(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_path = os.path.join(log_dir, "clicks.log")
+            client = Client()
+            with self.settings(CLICK_LOG_PATH=log_path):
+                response = client.get("/p/A81025", HTTP_USER_AGENT="Mozilla/5.0")
+                self.assertTemplateUsed(response, "questionnaire.html")
+                response = client.get("/e/A83050")
+                self.assertEqual(response.status_code, 302)
+                self.assertEqual(client.get("/e/A99999").status_code, 404)
+                # Nothing is counted until the log is flushed
+                self.assertEqual(Intervention.objects.get(pk=1).hits, 0)
+                self.assertFalse(ClickEvent.objects.exists())
+                with patch("nimodipine.clicks.time.sleep"):
+                    call_command("flush_clicks", stdout=StringIO())
+            self.assertEqual(os.listdir(log_dir), [])
+        self.assertEqual(Intervention.objects.get(pk=1).hits, 1)
+        self.assertEqual(InterventionContact.objects.get(pk="A83050").hits, 2)
+        self.assertEqual(Intervention.objects.get(pk=4).hits, 1)
+        self.assertEqual(InterventionContact.objects.get(pk="A81025").hits, 1)
+        self.assertEqual(
+            ClickEvent.objects.get(intervention_id=4).user_agent, "Mozilla/5.0"
+        )
+        self.assertEqual(ClickEvent.objects.count(), 2)
+
+    def test_flush_clicks_interrupted(self):
+        from nimodipine.clicks import flush_click_log
+
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_path = os.path.join(log_dir, "clicks.log")
+            with self.settings(CLICK_LOG_PATH=log_path):
+                Client().get("/e/A81025")
+            # Killed after committing the clicks, before removing the log
+            with patch("nimodipine.clicks.os.remove", side_effect=SystemExit):
+                with self.assertRaises(SystemExit):
+                    flush_click_log(log_path, grace=0)
+            self.assertEqual(flush_click_log(log_path, grace=0), 0)
+            self.assertEqual(os.listdir(log_dir), [])
+        self.assertEqual(Intervention.objects.get(pk=5).hits, 1)
+        self.assertEqual(ClickEvent.objects.count(), 1)
+
+    def test_buffered_repeat_click_skips_database(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            client = Client()
+            with self.settings(CLICK_LOG_PATH=os.path.join(log_dir, "clicks.log")):
+                with self.assertNumQueries(1):
+                    response = client.get("/e/A81025")
+                self.assertTemplateUsed(response, "questionnaire.html")
+                with self.assertNumQueries(0):
+                    response = client.get("/e/A81025")
+                self.assertEqual(response.status_code, 302)
+                # The contact has now visited, whichever link they use
+                with self.assertNumQueries(1):
+                    response = client.get("/p/A81025")
+                self.assertEqual(response.status_code, 302)
+
+    def test_buffered_click_after_visited_forgotten(self):
+        from nimodipine.clicks import flush_click_log
+
+        with tempfile.TemporaryDirectory() as log_dir:
+            client = Client()
+            with self.settings(CLICK_LOG_PATH=os.path.join(log_dir, "clicks.log")):
+                client.get("/e/A81025")
+                flush_click_log(os.path.join(log_dir, "clicks.log"), grace=0)
+                # As if culled from the cache
+                caches["redirects"].delete("visited:A81025")
+                with self.assertNumQueries(1):
+                    response = client.get("/e/A81025")
+                self.assertEqual(response.status_code, 302)
+                # Looked up once, then cached again
+                with self.assertNumQueries(0):
+                    response = client.get("/e/A81025")
+                self.assertEqual(response.status_code, 302)
+
+    def test_unknown_intervention_click(self):
+        response = Client().get("/e/A99999")
+        self.assertEqual(response.status_code, 404)
+        response = Client().post("/e/A99999", {"survey_response": "Yes"})
+        self.assertEqual(response.status_code, 404)
 
     def test_fax_receipt_success(self):
         data = {
@@ -137,6 +519,22 @@ class ViewTestCase(TestCase):
         Intervention.objects.get(pk=2)
         self.assertEqual(response.status_code, 404)
 
+    def test_fax_receipt_temporary(self):
+        data = {
+            "DestinationFax": "00441642260897",
+            "Subject": "message about your prescribing",
+            "Status": "-1",
+        }
+        with self.assertNumQueries(1):
+            response = Client().post("/fax_receipt", data)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(Intervention.objects.get(pk=2).receipt)
+
+    def test_fax_receipt_is_one_query(self):
+        data = {"DestinationFax": "00441642260897", "Status": "0"}
+        with self.assertNumQueries(1):
+            Client().post("/fax_receipt", data)
+
 
 class InterventionCommandTestCase(TestCase):
     def test_create_interventions(self):
@@ -153,25 +551,491 @@ class InterventionCommandTestCase(TestCase):
             Intervention.objects.filter(contact__name="THE DOVECOT SURGERY").count(), 3
         )
 
+    def test_create_interventions_bulk(self):
+        contacts = os.path.join(settings.BASE_DIR, "nimodipine/fixtures/contacts.csv")
+        args = []
+        opts = {"contacts": contacts, "bulk": True}
+        call_command("create_interventions", *args, **opts)
+
+        self.assertEqual(Intervention.objects.count(), 9)
+        self.assertEqual(Intervention.objects.filter(method="e").count(), 3)
+        contact = InterventionContact.objects.get(practice_id="A81025")
+        self.assertEqual(contact.normalised_fax, "00441642260897")
+        self.assertEqual(contact.cased_name, "The Dovecot Surgery")
+        self.assertEqual(contact.intervention_set.count(), 3)
+
+    def test_create_interventions_incremental(self):
+        contacts = os.path.join(settings.BASE_DIR, "nimodipine/fixtures/contacts.csv")
+        call_command("create_interventions", contacts=contacts)
+        Intervention.objects.filter(practice_id="A81025").update(hits=2, sent=True)
+
+        with open(contacts, "r") as f:
+            rows = list(csv.DictReader(f))
+        rows[0]["practice_name"] = "THE NEW DOVECOT SURGERY"
+        rows[0]["value"] = "25"
+        removed = rows.pop()
+        with tempfile.NamedTemporaryFile("w", suffix=".csv") as changed:
+            writer = csv.DictWriter(changed, fieldnames=rows[0].keys())
+            writer.writeheader()
+            writer.writerows(rows)
+            changed.flush()
+            out = StringIO()
+            call_command(
+                "create_interventions",
+                contacts=changed.name,
+                incremental=True,
+                stdout=out,
+            )
+            self.assertIn("0 contacts inserted, 1 updated, 1 retired", out.getvalue())
+
+            out = StringIO()
+            call_command(
+                "create_interventions",
+                contacts=changed.name,
+                incremental=True,
+                stdout=out,
+            )
+            self.assertIn("0 contacts inserted, 0 updated, 0 retired", out.getvalue())
+
+        contact = InterventionContact.objects.get(practice_id="A81025")
+        self.assertEqual(contact.name, "THE NEW DOVECOT SURGERY")
+        self.assertEqual(contact.cased_name, "The New Dovecot Surgery")
+        intervention = contact.intervention_set.get(method="e")
+        self.assertEqual(intervention.hits, 2)
+        self.assertTrue(intervention.sent)
+        self.assertEqual(intervention.metadata, {"value": "25"})
+        self.assertTrue(
+            InterventionContact.objects.get(practice_id=removed["practice"]).retired
+        )
+        self.assertEqual(Intervention.objects.count(), 9)
+
 
 class WaveGenerationCommandTestCase(TestCase):
     fixtures = ["intervention_contacts", "interventions"]
 
-    @patch("nimodipine.management.commands.generate_wave.requests")
-    def test_generate_wave(self, mock_request):
+    def test_generate_wave(self):
         args = []
         opts = {"method": "e"}
-        mock_request.get = Client().get
-        mock_request.codes.ok = 200
-        call_command("generate_wave", *args, **opts)
-        intervention = Intervention.objects.first()
-        path = intervention.message_path()
+        with tempfile.TemporaryDirectory() as data_dir:
+            with self.settings(DATA_DIR=data_dir):
+                call_command("generate_wave", *args, **opts)
+                intervention = Intervention.objects.first()
+                path = intervention.message_path()
+                email = open(path, "r").read()
         expected = 'You can learn more about how your prescription rates for nimodipine compare to other practices at <a href="http://op2.org.uk/e/{practice_id}">op2.org.uk/e/{practice_id}</a>'.format(
             practice_id=intervention.practice_id
         )
-        email = open(path, "r").read()
         self.assertIn(expected, email)
 
+    @patch("nimodipine.combining.subprocess.check_call")
+    @patch("nimodipine.management.commands.generate_wave.capture_html")
+    def test_generate_wave_manifest(self, mock_capture_html, mock_check_call):
+        from nimodipine.manifest import artefact_paths
+        from nimodipine.manifest import open_manifest
+
+        def capture_html(url, target_path):
+            with open(target_path, "wb") as f:
+                f.write(b"%PDF")
+
+        mock_capture_html.side_effect = capture_html
+        mock_check_call.side_effect = fake_gs
+        with tempfile.TemporaryDirectory() as data_dir:
+            # An email generated before there was a manifest
+            old_email = os.path.join(data_dir, "email", "A83050")
+            os.makedirs(old_email)
+            open(os.path.join(old_email, "email.html"), "w").close()
+            with self.settings(DATA_DIR=data_dir):
+                call_command("generate_wave", method="h")
+                # Nothing was generated, so there's no manifest yet
+                self.assertIsNone(open_manifest())
+                call_command("generate_wave", method="p")
+                manifest = open_manifest()
+                letters = artefact_paths(manifest, method="p")
+                size, sha1 = manifest.execute(
+                    "SELECT size, sha1 FROM artefact WHERE path = 'post/A83050/letter.pdf'"
+                ).fetchone()
+                manifest.close()
+                self.assertEqual(
+                    letters,
+                    [
+                        os.path.join(data_dir, "post", "A81025", "letter.pdf"),
+                        os.path.join(data_dir, "post", "A83050", "letter.pdf"),
+                    ],
+                )
+                self.assertEqual((size, sha1), (4, hashlib.sha1(b"%PDF").hexdigest()))
+                # The letters to combine come from the manifest
+                self.assertEqual(mock_check_call.call_args[0][0][-2:], letters)
+                mock_check_call.reset_mock()
+                call_command("combine_letters", stdout=StringIO())
+                mock_check_call.assert_not_called()
+                # Only the rendered files (and no temporary ones) are left
+                self.assertEqual(
+                    os.listdir(os.path.join(data_dir, "post", "A83050")),
+                    ["letter.pdf"],
+                )
+
+                with patch(
+                    "nimodipine.management.commands.send_messages.send_email_messages"
+                ) as mock_send, patch("builtins.input", return_value="y"):
+                    call_command("send_messages", method="email")
+                self.assertEqual(mock_send.call_args[0][0], [old_email])
+
+    def test_render_intervention_message(self):
+        from nimodipine.rendering import render_intervention_message
+
+        intervention = Intervention.objects.get(pk=3)  # post
+        html = render_intervention_message(intervention)
+        self.assertIn("PRESCRIBING LEAD, THE DOVECOT SURGERY", html)
+        self.assertEqual(html, Client().get("/msg/3").content.decode("utf8"))
+
+    def test_render_email_message(self):
+        from nimodipine.rendering import compiled_email_template
+        from nimodipine.rendering import inline_css
+        from nimodipine.rendering import render_email_message
+        from nimodipine.rendering import render_intervention_message
+
+        intervention = Intervention.objects.get(pk=1)
+        intervention.contact.cased_name = nhs_titlecase("SMITH & JONES <PARTNERSHIP>")
+        expected = inline_css(render_intervention_message(intervention, "cafe"))
+        self.assertEqual(render_email_message(intervention, "cafe"), expected)
+        self.assertIn("Smith &amp; Jones &lt;partnership&gt;", expected)
+        # The template is only inlined once
+        with patch("nimodipine.rendering.inline_css") as mock_inline_css:
+            render_email_message(Intervention.objects.get(pk=5), "cafe")
+        mock_inline_css.assert_not_called()
+        self.assertEqual(compiled_email_template.cache_info().currsize, 1)
+
+    @patch("nimodipine.management.commands.generate_wave.email_template_version")
+    def test_generate_wave_template_version(self, mock_email_template_version):
+        from nimodipine.management.commands.generate_wave import generate_messages
+        from nimodipine.rendering import email_template_version
+
+        mock_email_template_version.return_value = email_template_version()
+        interventions = list(Intervention.objects.filter(method="e"))
+        with tempfile.TemporaryDirectory() as data_dir:
+            with self.settings(DATA_DIR=data_dir):
+                with patch(
+                    "nimodipine.rendering.email_template_version"
+                ) as mock_rendering_version:
+                    self.assertEqual(generate_messages(interventions), (2, 0))
+        # Found once for the whole wave, not for each email
+        mock_email_template_version.assert_called_once_with()
+        mock_rendering_version.assert_not_called()
+
+    @patch("nimodipine.management.commands.generate_wave.generate_message")
+    def test_generate_messages_bad_chart_value(self, mock_generate_message):
+        from nimodipine.management.commands.generate_wave import generate_messages
+
+        def generate(intervention, encoded_image, template_version):
+            path = intervention.message_path()
+            os.makedirs(os.path.dirname(path))
+            open(path, "w").close()
+
+        mock_generate_message.side_effect = generate
+        Intervention.objects.filter(pk=1).update(metadata={})
+        interventions = list(Intervention.objects.filter(pk__in=[1, 5]))
+        with tempfile.TemporaryDirectory() as data_dir:
+            with self.settings(DATA_DIR=data_dir):
+                generated, failed = generate_messages(interventions)
+        self.assertEqual((generated, failed), (1, 1))
+        self.assertEqual(mock_generate_message.call_args[0][0].pk, 5)
+
+    @patch("nimodipine.management.commands.generate_wave.generate_message")
+    def test_generate_messages_isolates_failures(self, mock_generate_message):
+        from nimodipine.management.commands.generate_wave import generate_messages
+
+        def generate(intervention, encoded_image, template_version):
+            if intervention.method == "f":
+                raise Exception("PhantomJS fell over")
+            path = intervention.message_path()
+            os.makedirs(os.path.dirname(path))
+            open(path, "w").close()
+
+        mock_generate_message.side_effect = generate
+        interventions = list(Intervention.objects.filter(practice_id="A83050"))
+        with tempfile.TemporaryDirectory() as data_dir:
+            with self.settings(DATA_DIR=data_dir):
+                generated, failed = generate_messages(interventions, workers=2)
+        self.assertEqual((generated, failed), (2, 1))
+        self.assertEqual(
+            set(
+                Intervention.objects.filter(
+                    practice_id="A83050", generated=True
+                ).values_list("method", flat=True)
+            ),
+            {"e", "p"},
+        )
+
+    @patch("nimodipine.management.commands.generate_wave.generate_message")
+    def test_generate_wave_resume(self, mock_generate_message):
+        from nimodipine.journal import Journal
+
+        failures = [Exception("PhantomJS fell over")]
+
+        def generate(intervention, encoded_image, template_version):
+            if failures:
+                raise failures.pop()
+            path = intervention.message_path()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "w").close()
+
+        mock_generate_message.side_effect = generate
+        with tempfile.TemporaryDirectory() as data_dir:
+            with self.settings(DATA_DIR=data_dir):
+                out = StringIO()
+                with self.assertRaisesRegex(CommandError, "--resume"):
+                    call_command("generate_wave", method="e", stdout=out)
+                failed = mock_generate_message.call_args_list[0][0][0]
+                run_id = out.getvalue().split("Run ID: ")[1].strip()
+                self.assertEqual(
+                    Journal.resume(run_id, "generate_wave").pending(), [failed.pk]
+                )
+
+                mock_generate_message.reset_mock()
+                with patch(
+                    "nimodipine.management.commands.generate_wave.Command.find_pending"
+                ) as mock_find_pending:
+                    call_command("generate_wave", resume=run_id, stdout=StringIO())
+                mock_find_pending.assert_not_called()
+                self.assertEqual(mock_generate_message.call_count, 1)
+                self.assertEqual(mock_generate_message.call_args[0][0], failed)
+                self.assertEqual(Journal.resume(run_id, "generate_wave").pending(), [])
+
+
+def fake_gs(args):
+    """Stand in for Ghostscript, "merging" PDFs by concatenating them"""
+    output = [arg for arg in args if arg.startswith("-sOutputFile=")][0]
+    with open(output.split("=", 1)[1], "w") as f:
+        for path in args[args.index(output) + 1 :]:
+            f.write(open(path).read())
+
+
+@patch("nimodipine.combining.subprocess.check_call", side_effect=fake_gs)
+class CombineLettersTestCase(TestCase):
+    fixtures = ["intervention_contacts", "interventions"]
+
+    def setUp(self):
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.settings_override = self.settings(DATA_DIR=self.data_dir.name)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.data_dir.cleanup()
+
+    def write_letter(self, manifest, practice_id, content):
+        from nimodipine.manifest import record_artefact
+
+        intervention = Intervention(method="p", practice_id=practice_id)
+        path = intervention.message_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+        record_artefact(manifest, intervention, path)
+
+    def test_tree_merge(self, mock_check_call):
+        from nimodipine.combining import merge_pdfs
+
+        inputs = []
+        for i in range(7):
+            path = os.path.join(self.data_dir.name, "{}.pdf".format(i))
+            with open(path, "w") as f:
+                f.write(str(i))
+            inputs.append(path)
+        output = os.path.join(self.data_dir.name, "out.pdf")
+        merge_pdfs(inputs, output, workers=2, fan_in=2)
+        self.assertEqual(open(output).read(), "0123456")
+        # 4 merges of the letters, then 2, then 1
+        self.assertEqual(mock_check_call.call_count, 7)
+        self.assertEqual(sorted(os.listdir(self.data_dir.name))[-1], "out.pdf")
+        self.assertEqual(len(os.listdir(self.data_dir.name)), 8)
+
+    def test_incremental_batches_by_postcode(self, mock_check_call):
+        from nimodipine.combining import combine_letters
+        from nimodipine.manifest import open_manifest
+
+        InterventionContact.objects.filter(pk="A83050").update(postcode="AB1 1AA")
+        manifest = open_manifest(create=True)
+        self.write_letter(manifest, "A83050", "A")
+        self.write_letter(manifest, "A81025", "B")
+        self.write_letter(manifest, "A00001", "C")
+        outputs = combine_letters(batch_size=2, by_postcode=True)
+        self.assertEqual(
+            [open(output).read() for output in outputs], ["CA", "B"],
+        )
+        self.assertEqual(combine_letters(), [])
+
+        # Only new and changed letters are combined next time
+        self.write_letter(manifest, "A81025", "D")
+        self.write_letter(manifest, "A00002", "E")
+        manifest.close()
+        outputs = combine_letters()
+        self.assertEqual([open(output).read() for output in outputs], ["ED"])
+
+    def test_without_manifest(self, mock_check_call):
+        from nimodipine.combining import combine_letters
+
+        for practice_id in ["A83050", "A81025"]:
+            path = Intervention(method="p", practice_id=practice_id).message_path()
+            os.makedirs(os.path.dirname(path))
+            with open(path, "w") as f:
+                f.write(practice_id)
+        outputs = combine_letters()
+        self.assertEqual(
+            outputs, [os.path.join(self.data_dir.name, "combined_letters.pdf")]
+        )
+        self.assertEqual(len(open(outputs[0]).read()), 12)
+
+
+class ChartTestCase(TestCase):
+    def setUp(self):
+        from nimodipine.rendering import _cached_chart
+
+        _cached_chart.cache_clear()
+
+    def test_chart_cached_by_geometry(self):
+        from nimodipine.rendering import _cached_chart
+        from nimodipine.rendering import make_chart
+
+        # These differ, but round to the same label and x position
+        self.assertEqual(make_chart(10), make_chart("10.2"))
+        self.assertEqual(_cached_chart.cache_info().hits, 1)
+        self.assertNotEqual(make_chart(10), make_chart(100))
+
+    def test_make_charts(self):
+        from nimodipine.rendering import make_chart
+        from nimodipine.rendering import make_charts
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with self.settings(CHART_CACHE_DIR=cache_dir):
+                charts = make_charts([(1, 10), (2, "10.2"), (3, 100)])
+            # Each distinct chart is drawn once, through the chart cache
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+        self.assertEqual(charts[1], make_chart(10))
+        self.assertIs(charts[1], charts[2])
+        self.assertEqual(charts[3], make_chart(100))
+
+    def test_make_charts_bad_value(self):
+        from nimodipine.rendering import make_charts
+
+        charts = make_charts([(1, 10), (2, None), (3, "")])
+        self.assertEqual(list(charts), [1])
+
+    def test_chart_disk_cache(self):
+        from nimodipine.rendering import _cached_chart
+        from nimodipine.rendering import chart_geometry
+        from nimodipine.rendering import make_chart
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with self.settings(CHART_CACHE_DIR=cache_dir):
+                encoded = make_chart(20)
+                path = os.path.join(
+                    cache_dir, "chart-{}-{}.png".format(*chart_geometry(20))
+                )
+                with open(path, "rb") as f:
+                    self.assertEqual(
+                        base64.b64encode(f.read()).decode("ascii"), encoded
+                    )
+                _cached_chart.cache_clear()
+                with patch("nimodipine.rendering.draw_chart") as mock_draw_chart:
+                    self.assertEqual(make_chart(20), encoded)
+                    mock_draw_chart.assert_not_called()
+
+
+class StaticImageTestCase(TestCase):
+    def test_static_image_reloaded_when_changed(self):
+        from nimodipine.rendering import static_image
+
+        with tempfile.TemporaryDirectory() as base_dir:
+            static_dir = os.path.join(base_dir, "nimodipine", "static")
+            os.makedirs(static_dir)
+            path = os.path.join(static_dir, "header.png")
+            with open(path, "wb") as f:
+                f.write(b"old")
+            os.utime(path, (1, 1))
+            with self.settings(BASE_DIR=base_dir):
+                self.assertEqual(static_image("header.png"), "b2xk")
+                with patch("nimodipine.rendering.open") as mock_open:
+                    self.assertEqual(static_image("header.png"), "b2xk")
+                    mock_open.assert_not_called()
+                with open(path, "wb") as f:
+                    f.write(b"new")
+                os.utime(path, (2, 2))
+                self.assertEqual(static_image("header.png"), "bmV3")
+
+    def test_static_image_attachment_names(self):
+        from nimodipine.management.commands.send_messages import inline_images
+        from nimodipine.rendering import static_image
+        from django.core.mail import EmailMultiAlternatives
+
+        html = '<img src="data:image/png;base64,{}"> <img src="data:image/png;base64,cafe">'.format(
+            static_image("footer.png")
+        )
+        msg = inline_images(EmailMultiAlternatives(subject="foo"), html)
+        filenames = [x.get_filename() for x in msg.attachments]
+        self.assertEqual(filenames, ["footer.png", "chart-984e18fe201c.png"])
+
+
+class RendererTestCase(TestCase):
+    @patch("nimodipine.management.commands.generate_wave.subprocess")
+    @patch("common.renderer.requests.post")
+    def test_capture_html_uses_renderer(self, mock_post, mock_subprocess):
+        from nimodipine.management.commands.generate_wave import capture_html
+
+        mock_post.return_value = Mock(status_code=200)
+        with self.settings(RENDERER_URLS=["http://127.0.0.1:8910/"]):
+            capture_html("http://localhost/msg/1", "/tmp/letter.pdf")
+        mock_post.assert_called_once_with(
+            "http://127.0.0.1:8910/",
+            json={
+                "format": "pdf",
+                "url": "http://localhost/msg/1",
+                "output": "/tmp/letter.pdf",
+            },
+            timeout=settings.RENDERER_TIMEOUT,
+        )
+        mock_subprocess.check_output.assert_not_called()
+
+    @patch("nimodipine.management.commands.generate_wave.subprocess")
+    @patch("common.renderer.requests.post")
+    def test_capture_html_falls_back_to_subprocess(self, mock_post, mock_subprocess):
+        from nimodipine.management.commands.generate_wave import capture_html
+        import requests
+
+        mock_post.side_effect = requests.ConnectionError()
+        with self.settings(RENDERER_URLS=["http://127.0.0.1:8910/"]):
+            capture_html("http://localhost/msg/1", "/tmp/letter.pdf")
+        mock_subprocess.check_output.assert_called_once_with(
+            '{} "http://localhost/msg/1" /tmp/letter.pdf'.format(settings.PRINT_CMD),
+            shell=True,
+        )
+
+    @patch("nimodipine.management.commands.generate_wave.subprocess")
+    @patch("common.renderer.requests.post")
+    def test_capture_html_falls_back_on_renderer_timeout(
+        self, mock_post, mock_subprocess
+    ):
+        from nimodipine.management.commands.generate_wave import capture_html
+        import requests
+
+        mock_post.side_effect = requests.Timeout()
+        with self.settings(RENDERER_URLS=["http://127.0.0.1:8910/"]):
+            capture_html("http://localhost/msg/1", "/tmp/letter.pdf")
+        mock_subprocess.check_output.assert_called_once()
+
+    @patch("nimodipine.management.commands.generate_wave.subprocess")
+    @patch("common.renderer.requests.post")
+    def test_capture_html_falls_back_on_renderer_error(
+        self, mock_post, mock_subprocess
+    ):
+        from nimodipine.management.commands.generate_wave import capture_html
+        import requests
+
+        mock_post.return_value.raise_for_status.side_effect = requests.HTTPError()
+        with self.settings(RENDERER_URLS=["http://127.0.0.1:8910/"]):
+            capture_html("http://localhost/msg/1", "/tmp/letter.pdf")
+        mock_subprocess.check_output.assert_called_once()
+
 
 class EmailCommandTestCase(TestCase):
     fixtures = ["intervention_contacts", "interventions"]
@@ -188,8 +1052,32 @@ class EmailCommandTestCase(TestCase):
         cid = unquote(attachment.get("content-id"))
         self.assertIn('<img src="cid:{}">'.format(cid), msg.alternatives[0][0])
 
+    def test_email_images_shared(self):
+        from nimodipine.management.commands.send_messages import inline_images
+        from django.core.mail import EmailMultiAlternatives
+
+        html = '<img src="data:image/png;base64,cafe"> <img src="data:image/png;base64,cafe">'
+        msg1 = inline_images(EmailMultiAlternatives(subject="foo"), html)
+        msg2 = inline_images(EmailMultiAlternatives(subject="bar"), html)
+        # An image used twice is only attached once, and the same part is
+        # used for every message
+        self.assertEqual(len(msg1.attachments), 1)
+        self.assertIs(msg1.attachments[0], msg2.attachments[0])
+        cid = unquote(msg1.attachments[0].get("content-id"))
+        self.assertEqual(msg1.alternatives[0][0].count("cid:{}".format(cid)), 2)
+
+    def test_email_generated_text(self):
+        from nimodipine.management.commands.send_messages import build_email_message
+
+        intervention = Intervention.objects.get(pk=1)
+        html = "<p>some <b>html</b></p>"
+        msg = build_email_message(intervention, html, text="some text")
+        self.assertEqual(msg.body, "some text")
+        msg = build_email_message(intervention, html)
+        self.assertEqual(msg.body, "some **html**\n\n")
+
     def test_send_email(self):
-        from nimodipine.management.commands.send_messages import send_email_message
+        from nimodipine.management.commands.send_messages import send_email_messages
         from django.core.mail import outbox
 
         intervention_fixtures = os.path.join(
@@ -198,7 +1086,7 @@ class EmailCommandTestCase(TestCase):
         msg_path = os.path.join(intervention_fixtures, "email", "A83050")
         with self.settings(DATA_DIR=intervention_fixtures):
             self.assertFalse(Intervention.objects.get(pk=1).sent)
-            send_email_message(msg_path)
+            self.assertEqual(send_email_messages([msg_path]), 1)
             self.assertTrue(Intervention.objects.get(pk=1).sent)
             self.assertEqual(len(outbox), 1)
             self.assertEqual(len(outbox[0].attachments), 1)
@@ -209,7 +1097,7 @@ class EmailCommandTestCase(TestCase):
             )
 
     def test_email_dry_run(self):
-        from nimodipine.management.commands.send_messages import send_email_message
+        from nimodipine.management.commands.send_messages import send_email_messages
         from django.core.mail import outbox
 
         intervention_fixtures = os.path.join(
@@ -217,18 +1105,223 @@ class EmailCommandTestCase(TestCase):
         )
         msg_path = os.path.join(intervention_fixtures, "email", "A83050")
         with self.settings(DATA_DIR=intervention_fixtures):
-            send_email_message(msg_path, dry_run=True)
+            send_email_messages([msg_path], dry_run=True)
             self.assertEqual(len(outbox), 0)
+            self.assertFalse(Intervention.objects.get(pk=1).sent)
+
+    @patch("nimodipine.management.commands.send_messages.get_connection")
+    def test_send_email_batches(self, mock_get_connection):
+        from nimodipine.management.commands.send_messages import send_email_messages
+
+        intervention_fixtures = os.path.join(
+            settings.BASE_DIR, "nimodipine/fixtures/interventions/"
+        )
+        msg_path = os.path.join(intervention_fixtures, "email", "A83050")
+        connection = mock_get_connection.return_value.__enter__.return_value
+        with self.settings(DATA_DIR=intervention_fixtures):
+            sent = send_email_messages([msg_path], workers=2, rate=100)
+            self.assertEqual(sent, 1)
+            self.assertEqual(connection.send_messages.call_count, 1)
+            self.assertTrue(Intervention.objects.get(pk=1).sent)
+            # Already sent, so not sent again
+            self.assertEqual(send_email_messages([msg_path]), 0)
+            self.assertEqual(connection.send_messages.call_count, 1)
+
+    @patch("nimodipine.management.commands.send_messages.get_connection")
+    def test_send_email_batch_failure(self, mock_get_connection):
+        from nimodipine.management.commands.send_messages import send_email_messages
+
+        intervention_fixtures = os.path.join(
+            settings.BASE_DIR, "nimodipine/fixtures/interventions/"
+        )
+        msg_path = os.path.join(intervention_fixtures, "email", "A83050")
+        connection = mock_get_connection.return_value.__enter__.return_value
+        connection.send_messages.side_effect = Exception("Mailgun is down")
+        with self.settings(DATA_DIR=intervention_fixtures):
+            self.assertEqual(send_email_messages([msg_path]), 0)
+            self.assertFalse(Intervention.objects.get(pk=1).sent)
+
+    @patch("nimodipine.management.commands.send_messages.get_connection")
+    def test_send_email_rejected(self, mock_get_connection):
+        from nimodipine.management.commands import send_messages
+        from nimodipine.journal import Journal
+
+        connection = mock_get_connection.return_value.__enter__.return_value
+        # The first address is rejected, but the rest of the batch is sent
+        connection.send_messages.side_effect = [Exception("Rejected"), 1]
+        with tempfile.TemporaryDirectory() as data_dir:
+            fixture = os.path.join(
+                settings.BASE_DIR, "nimodipine/fixtures/interventions/email/A83050"
+            )
+            msg_paths = []
+            for practice_id in ["A83050", "A81025"]:
+                msg_path = os.path.join(data_dir, "email", practice_id)
+                shutil.copytree(fixture, msg_path)
+                msg_paths.append(msg_path)
+            with self.settings(DATA_DIR=data_dir):
+                journal = Journal.start("send_messages", [1, 5])
+                sent = send_messages.send_email_messages(msg_paths, journal=journal)
+                journal.close()
+        self.assertEqual(sent, 1)
+        self.assertEqual(connection.send_messages.call_count, 2)
+        self.assertFalse(Intervention.objects.get(pk=1).sent)
+        self.assertTrue(Intervention.objects.get(pk=5).sent)
+        self.assertEqual(journal.state(1), "failed")
+        self.assertEqual(journal.state(5), "done")
+
+    @patch("nimodipine.management.commands.send_messages.get_connection")
+    def test_send_email_connection_lost(self, mock_get_connection):
+        from smtplib import SMTPServerDisconnected
+        from nimodipine.management.commands import send_messages
+
+        connection = mock_get_connection.return_value.__enter__.return_value
+        connection.send_messages.side_effect = SMTPServerDisconnected()
+        with tempfile.TemporaryDirectory() as data_dir:
+            fixture = os.path.join(
+                settings.BASE_DIR, "nimodipine/fixtures/interventions/email/A83050"
+            )
+            msg_paths = []
+            for practice_id in ["A83050", "A81025"]:
+                msg_path = os.path.join(data_dir, "email", practice_id)
+                shutil.copytree(fixture, msg_path)
+                msg_paths.append(msg_path)
+            with self.settings(DATA_DIR=data_dir):
+                self.assertEqual(send_messages.send_email_messages(msg_paths), 0)
+        # The rest of the batch is abandoned
+        self.assertEqual(connection.send_messages.call_count, 1)
+
+    @patch("nimodipine.management.commands.send_messages.get_connection")
+    def test_send_email_interrupted(self, mock_get_connection):
+        from nimodipine.management.commands import send_messages
+
+        connection = mock_get_connection.return_value.__enter__.return_value
+
+        class InterruptedQueue(queue.Queue):
+            interrupted = False
+
+            def get(self, *args, **kwargs):
+                if self.interrupted:
+                    return super().get(*args, **kwargs)
+                # Ctrl-C once the first email has been sent
+                self.interrupted = True
+                self.put(super().get(*args, **kwargs))
+                raise KeyboardInterrupt
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            fixture = os.path.join(
+                settings.BASE_DIR, "nimodipine/fixtures/interventions/email/A83050"
+            )
+            msg_paths = []
+            for practice_id in ["A83050", "A81025"]:
+                msg_path = os.path.join(data_dir, "email", practice_id)
+                shutil.copytree(fixture, msg_path)
+                msg_paths.append(msg_path)
+            with self.settings(DATA_DIR=data_dir), patch.object(
+                send_messages.queue, "Queue", InterruptedQueue
+            ):
+                with self.assertRaises(KeyboardInterrupt):
+                    send_messages.send_email_messages(msg_paths, rate=5)
+        # The email sent before the interrupt is recorded, and no more
+        # are sent
+        self.assertEqual(connection.send_messages.call_count, 1)
+        self.assertTrue(Intervention.objects.get(pk=1).sent)
+        self.assertFalse(Intervention.objects.get(pk=5).sent)
+
+    @patch("nimodipine.management.commands.send_messages.send_email_messages")
+    def test_send_messages_resume(self, mock_send):
+        from nimodipine.journal import Journal
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            with self.settings(DATA_DIR=data_dir):
+                journal = Journal.start(
+                    "send_messages",
+                    [1, 5],
+                    methods=["email"],
+                    test_recipient="test@example.com",
+                    dry_run=False,
+                )
+                # Interrupted after sending the first email, but before
+                # marking it as sent
+                journal.record(1, "done")
+                journal.close()
+                with patch("builtins.input", return_value="y"):
+                    with self.assertNumQueries(2):
+                        call_command(
+                            "send_messages", resume=journal.run_id, stdout=StringIO()
+                        )
+                msg_path = os.path.join(data_dir, "email", "A81025")
+        self.assertTrue(Intervention.objects.get(pk=1).sent)
+        self.assertEqual(mock_send.call_args[0][:2], ([msg_path], "test@example.com"))
+        self.assertEqual(
+            mock_send.call_args[1]["interventions"][msg_path],
+            Intervention.objects.get(pk=5),
+        )
+
+    def test_send_messages_resume_unstarted(self):
+        from nimodipine.journal import journal_path
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            with self.settings(DATA_DIR=data_dir):
+                path = journal_path("send_messages-1")
+                os.makedirs(os.path.dirname(path))
+                with open(path, "w") as f:
+                    f.write('{"run": "send_mess')
+                with patch("builtins.input", return_value="y"):
+                    with self.assertRaisesRegex(CommandError, "stopped before"):
+                        call_command("send_messages", resume="send_messages-1")
+
+    def test_journal_resume_after_partial_line(self):
+        from nimodipine.journal import Journal
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            with self.settings(DATA_DIR=data_dir):
+                journal = Journal.start("send_messages", [1, 5, 6])
+                journal.record(1, "done")
+                # Killed part way through writing an entry
+                journal.f.write('{"item": 5, "sta')
+                journal.close()
+                journal = Journal.resume(journal.run_id, "send_messages")
+                journal.record(6, "done")
+                journal.close()
+                journal = Journal.resume(journal.run_id, "send_messages")
+        self.assertEqual(journal.pending(), [5])
 
 
 class FaxCommandTestCase(TestCase):
     fixtures = ["intervention_contacts", "interventions"]
 
+    def test_replay_fax_receipts(self):
+        Intervention.objects.create(
+            method="f", practice_id="A81025", contact_id="A81025"
+        )
+        with tempfile.NamedTemporaryFile("w", suffix=".csv") as f:
+            f.write(
+                "DestinationFax,Status\n"
+                "+44 1642 260897,0\n"
+                "01642 260898,0\n"
+                "01642 260898,-1\n"
+                "01642 260898,3931\n"
+                "01234 567890,0\n"
+                "01642 260898,\n"
+                "01642 260898,Completed\n"
+            )
+            f.flush()
+            out = StringIO()
+            call_command("replay_fax_receipts", csv=f.name, stdout=out)
+        self.assertIn("1 interventions marked as received", out.getvalue())
+        self.assertIn("1 interventions marked as failed", out.getvalue())
+        self.assertIn("2 records with unreadable statuses skipped", out.getvalue())
+        self.assertIs(Intervention.objects.get(pk=2).receipt, True)
+        self.assertIs(
+            Intervention.objects.get(method="f", practice_id="A81025").receipt, False
+        )
+
     @patch("nimodipine.management.commands.send_messages.InterFAX")
     def test_send_fax(self, mock_interfax):
-        from nimodipine.management.commands.send_messages import send_fax_message
+        from nimodipine.management.commands.send_messages import send_fax_messages
 
         mock_interfax_instance = Mock()
+        mock_interfax_instance.deliver.return_value = Mock(id=1234)
         mock_interfax.return_value = mock_interfax_instance
         intervention_fixtures = os.path.join(
             settings.BASE_DIR, "nimodipine/fixtures/interventions/"
@@ -236,8 +1329,9 @@ class FaxCommandTestCase(TestCase):
         msg_path = os.path.join(intervention_fixtures, "fax", "A83050")
         with self.settings(DATA_DIR=intervention_fixtures):
             self.assertFalse(Intervention.objects.get(pk=2).sent)
-            send_fax_message(msg_path)
+            self.assertEqual(send_fax_messages([msg_path]), 1)
             self.assertTrue(Intervention.objects.get(pk=2).sent)
+            self.assertEqual(Intervention.objects.get(pk=2).fax_id, "1234")
             mock_interfax_instance.deliver.assert_called_with(
                 "00441642260897",
                 contact="Prescribing Lead",
@@ -253,7 +1347,7 @@ class FaxCommandTestCase(TestCase):
 
     @patch("nimodipine.management.commands.send_messages.InterFAX")
     def test_fax_dry_run(self, mock_interfax):
-        from nimodipine.management.commands.send_messages import send_fax_message
+        from nimodipine.management.commands.send_messages import send_fax_messages
 
         mock_interfax_instance = Mock()
         mock_interfax.return_value = mock_interfax_instance
@@ -262,6 +1356,94 @@ class FaxCommandTestCase(TestCase):
         )
         msg_path = os.path.join(intervention_fixtures, "fax", "A83050")
         with self.settings(DATA_DIR=intervention_fixtures):
-            send_fax_message(msg_path, dry_run=True)
-            to = "j"
+            self.assertEqual(send_fax_messages([msg_path], dry_run=True), 0)
             mock_interfax_instance.deliver.assert_not_called()
+            self.assertFalse(Intervention.objects.get(pk=2).sent)
+
+    @patch("nimodipine.management.commands.send_messages.InterFAX")
+    def test_send_faxes(self, mock_interfax):
+        from nimodipine.management.commands.send_messages import send_fax_messages
+
+        mock_interfax_instance = Mock()
+        mock_interfax_instance.deliver.return_value = Mock(id=1234)
+        mock_interfax.return_value = mock_interfax_instance
+        intervention_fixtures = os.path.join(
+            settings.BASE_DIR, "nimodipine/fixtures/interventions/"
+        )
+        msg_path = os.path.join(intervention_fixtures, "fax", "A83050")
+        with self.settings(DATA_DIR=intervention_fixtures):
+            self.assertEqual(send_fax_messages([msg_path], workers=2), 1)
+            self.assertEqual(send_fax_messages([msg_path], workers=2), 0)
+        self.assertEqual(mock_interfax.call_count, 2)
+        self.assertEqual(mock_interfax_instance.deliver.call_count, 1)
+        intervention = Intervention.objects.get(pk=2)
+        self.assertTrue(intervention.sent)
+        self.assertEqual(intervention.fax_id, "1234")
+
+    @patch("nimodipine.management.commands.send_messages.InterFAX")
+    def test_send_faxes_interrupted(self, mock_interfax):
+        from concurrent.futures import wait
+        from nimodipine.management.commands import send_messages
+
+        mock_interfax.return_value.deliver.return_value = Mock(id=1234)
+        Intervention.objects.create(
+            method="f", practice_id="A81025", contact_id="A81025", metadata={}
+        )
+
+        def interrupted_wait(*args, **kwargs):
+            # Ctrl-C while the first fax is being sent
+            wait(*args, **kwargs)
+            raise KeyboardInterrupt
+
+        msg_paths = [
+            os.path.join(settings.DATA_DIR, "fax", practice_id)
+            for practice_id in ["A83050", "A81025"]
+        ]
+        with patch.object(send_messages, "wait", interrupted_wait):
+            with self.assertRaises(KeyboardInterrupt):
+                send_messages.send_fax_messages(msg_paths)
+        # The fax that was being sent is recorded, and no more are sent
+        mock_interfax.return_value.deliver.assert_called_once()
+        intervention = Intervention.objects.get(pk=2)
+        self.assertTrue(intervention.sent)
+        self.assertEqual(intervention.fax_id, "1234")
+        self.assertFalse(
+            Intervention.objects.get(practice_id="A81025", method="f").sent
+        )
+
+    def test_reconcile_fax_receipts(self):
+        from nimodipine.management.commands.reconcile_faxes import (
+            reconcile_fax_receipts,
+        )
+
+        Intervention.objects.filter(pk=2).update(sent=True, fax_id="1234")
+        interfax = Mock()
+        interfax.outbound.completed.return_value = [Mock(id=1234, status=0)]
+        self.assertEqual(reconcile_fax_receipts(interfax), (1, 0, 0))
+        interfax.outbound.completed.assert_called_once_with("1234")
+        self.assertTrue(Intervention.objects.get(pk=2).receipt)
+
+    def test_reconcile_fax_receipts_unreadable_status(self):
+        from nimodipine.management.commands.reconcile_faxes import (
+            reconcile_fax_receipts,
+        )
+
+        Intervention.objects.filter(pk=2).update(sent=True, fax_id="1234")
+        Intervention.objects.create(
+            method="f",
+            practice_id="A81025",
+            contact_id="A81025",
+            sent=True,
+            fax_id="5678",
+        )
+        interfax = Mock()
+        interfax.outbound.completed.return_value = [
+            Mock(id=1234, status=""),
+            Mock(id=5678, status=3),
+        ]
+        # The unreadable status doesn't stop the rest being reconciled
+        self.assertEqual(reconcile_fax_receipts(interfax), (0, 1, 1))
+        self.assertIsNone(Intervention.objects.get(pk=2).receipt)
+        self.assertIs(
+            Intervention.objects.get(practice_id="A81025", method="f").receipt, False
+        )
@@ -0,0 +1,157 @@
+"use strict";
+// A long-lived renderer, so we only pay PhantomJS startup once rather
+// than once per letter. Started (several at a time) by `manage.py
+// run_renderers`.
+//
+// Usage: phantomjs render_server.js <port>
+//
+// POST a JSON job to the port, one of:
+//
+//   {"format": "pdf", "url": <url>, "output": <path>}
+//   {"format": "pdf", "html": <html>, "url": <base url>, "output": <path>}
+//   {"format": "png", "url": <url>, "output": <path>,
+//    "selector": <css selector>, "dimensions": "<width>x<height>",
+//    "wait": <ms>}
+//
+// PDFs are rendered as print_letter.js does, and PNGs as
+// grab_chart.js does. Responds 200 once the file has been written.
+var server = require('webserver').create(),
+    webpage = require('webpage'),
+    system = require('system');
+
+var port = system.args[1];
+
+function renderPdf(job, done) {
+  var page = webpage.create();
+  page.viewportSize = { width: 600, height: 600 };
+  page.paperSize = { format: 'A4', orientation: 'portrait', margin: '1cm' };
+  var onLoad = function (status) {
+    if (status !== 'success') {
+      page.close();
+      done('Unable to load the address!');
+      return;
+    }
+    window.setTimeout(function () {
+      page.evaluate(function() {
+        // force it to fit on A4
+        // For DPI discussion, see https://github.com/ebmdatalab/antibiotics-rct/issues/34
+        var dpi = 72;
+        var body = document.body,
+            html = document.documentElement;
+
+        var heightInPix = Math.max( body.scrollHeight, body.offsetHeight,
+                                    html.clientHeight, html.scrollHeight, html.offsetHeight );
+        var heightInCm = heightInPix * (2.54 / dpi);
+        var maxHeight = 27;  // alow for margins
+        if (heightInCm > maxHeight) {
+          document.body.style.zoom = maxHeight / heightInCm;
+        }
+        return;
+      });
+      page.render(job.output);
+      page.close();
+      done(null);
+    }, 200);
+  };
+  if (job.html) {
+    page.onLoadFinished = onLoad;
+    page.setContent(job.html, job.url || 'about:blank');
+  } else {
+    page.open(job.url, onLoad);
+  }
+}
+
+function renderImage(job, done) {
+  var page = webpage.create();
+  var parts = job.dimensions.split('x');
+  page.viewportSize = {
+    width: parseInt(parts[0], 10),
+    height: parseInt(parts[1], 10)
+  };
+  page.open(job.url, function (status) {
+    if (status !== 'success') {
+      page.close();
+      done('Unable to load the address!');
+      return;
+    }
+    waitFor({
+      extraWait: job.wait,
+      interval: 500,
+      timeout: 60000,
+      check: function() {
+        return page.evaluate(function(s) {
+          // trigger scroll-related events in measures pages.
+          // without this, we'd be screenshotting undrawn charts
+          $('body').scrollTop(1);
+          return $(s).is(':visible');
+        }, job.selector);
+      },
+      success: function() {
+        page.clipRect = page.evaluate(function(selector) {
+          var clipRect = document.querySelector(selector).getBoundingClientRect();
+          return {
+            top: clipRect.top,
+            left: clipRect.left,
+            width: clipRect.width,
+            height: clipRect.height
+          };
+        }, job.selector);
+        page.render(job.output);
+        page.close();
+        done(null);
+      },
+      error: function() {
+        page.close();
+        done('Error waiting for element ' + job.selector);
+      }
+    });
+  });
+}
+
+function waitFor($config) {
+  $config._start = $config._start || new Date();
+  if ($config.timeout && new Date() - $config._start > $config.timeout) {
+    $config.error();
+    return;
+  }
+  if ($config.check()) {
+    return setTimeout(function() {
+      return $config.success();
+    }, $config.extraWait); // the extra wait is for the graph to paint
+  }
+  setTimeout(waitFor, $config.interval || 0, $config);
+}
+
+var listening = server.listen('127.0.0.1:' + port, function (request, response) {
+  var finish = function (error) {
+    response.statusCode = error ? 500 : 200;
+    response.write(error || 'OK');
+    response.close();
+  };
+  if (request.method !== 'POST') {
+    response.statusCode = 405;
+    response.close();
+    return;
+  }
+  var job;
+  try {
+    job = JSON.parse(request.post);
+  } catch (e) {
+    finish('Unable to parse job: ' + e);
+    return;
+  }
+  try {
+    if (job.format === 'png') {
+      renderImage(job, finish);
+    } else {
+      renderPdf(job, finish);
+    }
+  } catch (e) {
+    finish('Failed to render ' + job.output + ': ' + e);
+  }
+});
+
+if (!listening) {
+  console.log('Unable to listen on port ' + port);
+  phantom.exit(1);
+}